@@ -1,9 +1,17 @@
+from __future__ import with_statement
+
 from django.contrib import admin
-from django.contrib.auth.models import Permission
+from django.contrib.admin import helpers
+from django.contrib.admin.util import flatten_fieldsets
 from django.contrib.contenttypes import generic 
 from django.contrib.contenttypes.models import ContentType
+from django.shortcuts import render_to_response
+from django.template import RequestContext
 
-from bop.models import ObjectPermission
+from bop.api import batch, grant, revoke
+from bop.forms import ObjectPermissionFormSet, permissions_formfield_callback, \
+    BulkPermissionForm
+from bop.models import ObjectPermission, get_permission_model
 
 
 class ObjectPermissionInline(generic.GenericTabularInline):
@@ -12,6 +20,7 @@ class ObjectPermissionInline(generic.GenericTabularInline):
 
     """
     model = ObjectPermission
+    formset = ObjectPermissionFormSet
     extra = 1
 
     # Need to override this entire method to pass a different
@@ -28,18 +37,12 @@ class ObjectPermissionInline(generic.GenericTabularInline):
         exclude.extend(self.get_readonly_fields(request, obj))
         exclude = exclude or None
 
-        def _formfield_callback(field, *args):
-            if field.name == 'permission':
-                ct = ContentType.objects.get_for_model(self.parent_model)
-                return field.formfield(
-                    queryset=Permission.objects.filter(content_type=ct))
-            return field.formfield()
-
         defaults = {
             "ct_field": self.ct_field,
             "fk_field": self.ct_fk_field,
             "form": self.form,
-            "formfield_callback": _formfield_callback,
+            "formfield_callback": permissions_formfield_callback(
+                self.parent_model),
             "formset": self.formset,
             "extra": self.extra,
             "can_delete": self.can_delete,
@@ -54,7 +57,11 @@ class ObjectPermissionInline(generic.GenericTabularInline):
 class ObjectAdmin(admin.ModelAdmin):
     """ Object Level Permissions in the admin
 
+    The grant_permissions and revoke_permissions actions change the
+    permissions of all selected objects at once.
     """
+    actions = ['grant_permissions', 'revoke_permissions']
+
     def __init__(self, *args, **kwargs):
         super(ObjectAdmin, self).__init__(*args, **kwargs)
         inline_instance = ObjectPermissionInline(self.model, self.admin_site)
@@ -65,13 +72,14 @@ class ObjectAdmin(admin.ModelAdmin):
         queryset = super(ObjectAdmin, self).queryset(request)
         if request.user.is_superuser:
             return queryset
-        allowed_ids = ObjectPermission.objects.get_for_model_and_user(
+        model = get_permission_model(self.model)
+        allowed_ids = model.objects.get_for_model_and_user(
             self.model, request.user).filter(
             permission__codename__in=(
                     opts.get_change_permission(),
                     opts.get_delete_permission()
                     )
-            ).values_list('object_id', flat=True).distinct()
+            ).values_list(model.object_field, flat=True).distinct()
         return queryset.filter(id__in=allowed_ids)
 
     def has_change_permission(self, request, obj=None):
@@ -81,3 +89,96 @@ class ObjectAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         opts = self.opts
         return request.user.has_perm(opts.app_label + '.' + opts.get_delete_permission(), obj)
+
+    def get_actions(self, request):
+        actions = super(ObjectAdmin, self).get_actions(request)
+        if not request.user.has_perm('bop.add_objectpermission'):
+            actions.pop('grant_permissions', None)
+        if not request.user.has_perm('bop.delete_objectpermission'):
+            actions.pop('revoke_permissions', None)
+        return actions
+
+    def _change_permissions(self, request, queryset, action, change, title):
+        """ Shows a form to choose the users, groups and permissions and
+        applies `change` (grant or revoke) to all objects in queryset
+        with a few bulk statements
+        """
+        if 'apply' in request.POST:
+            form = BulkPermissionForm(self.model, request.POST)
+            if form.is_valid():
+                objects = [self.model(pk=pk) for pk in
+                           queryset.values_list('pk', flat=True)]
+                with batch() as changes:
+                    change(form.cleaned_data['users'],
+                           form.cleaned_data['groups'],
+                           form.cleaned_data['permissions'], objects)
+                self.message_user(request, "%s: %d permissions on %d %s." % (
+                        title, len(changes.added) + len(changes.removed),
+                        len(objects), self.opts.verbose_name_plural))
+                return None
+        else:
+            form = BulkPermissionForm(self.model)
+        select_across = request.POST.get('select_across') == '1'
+        context = {
+            'title': title,
+            'form': form,
+            'opts': self.opts,
+            'app_label': self.opts.app_label,
+            'action': action,
+            'count': queryset.count(),
+            'select_across': select_across and 1 or 0,
+            'selected': not select_across and
+                request.POST.getlist(helpers.ACTION_CHECKBOX_NAME) or [],
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+            }
+        return render_to_response('admin/bop/change_permissions.html', context,
+                                  context_instance=RequestContext(request))
+
+    def grant_permissions(self, request, queryset):
+        return self._change_permissions(
+            request, queryset, 'grant_permissions', grant, "Grant permissions")
+    grant_permissions.short_description = "Grant permissions on the selected %(verbose_name_plural)s"
+
+    def revoke_permissions(self, request, queryset):
+        return self._change_permissions(
+            request, queryset, 'revoke_permissions', revoke, "Revoke permissions")
+    revoke_permissions.short_description = "Revoke permissions on the selected %(verbose_name_plural)s"
+
+
+class ObjectPermissionAdmin(admin.ModelAdmin):
+    """ Lists ObjectPermissions with a fixed number of queries per page
+
+    The columns are methods (not fields) so the changelist does not
+    replace the select_related of with_objects by its own.
+    """
+    list_display = ('subject', 'permission_label', 'content_type_name',
+                    'object_id', 'object_label')
+    list_filter = ('content_type', 'group')
+    search_fields = ('=user__username', '=group__name')
+    raw_id_fields = ('user', 'group')
+
+    def queryset(self, request):
+        return ObjectPermission.objects.with_objects()
+
+    def subject(self, op):
+        return op.user_id and op.user or op.group
+
+    def permission_label(self, op):
+        return "%s.%s" % (op.permission.content_type.app_label,
+                          op.permission.codename)
+    permission_label.short_description = 'permission'
+    permission_label.admin_order_field = 'permission'
+
+    def content_type_name(self, op):
+        return ContentType.objects.get_for_id(op.content_type_id)
+    content_type_name.short_description = 'content type'
+    content_type_name.admin_order_field = 'content_type'
+
+    def object_label(self, op):
+        return op.object
+    object_label.short_description = 'object'
+
+
+# Projects may register an admin of their own for ObjectPermission
+if ObjectPermission not in admin.site._registry:
+    admin.site.register(ObjectPermission, ObjectPermissionAdmin)
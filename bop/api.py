@@ -1,10 +1,22 @@
-import operator
+from __future__ import with_statement
 
+import threading
+from contextlib import contextmanager
+from hashlib import md5
+
+from django.conf import settings
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.db import models
 from django.db.models import Q
 
-from bop.models import ObjectPermission
+from bop.caches import preload_enabled, get_indexed_permissions, \
+    get_user_group_ids, get_user_version, get_versioned
+from bop.changelog import changes_since, current_version
+from bop.diagnostics import evaluate
+from bop.managers import PermissionKey, atomic, permission_key
+from bop.models import get_permission_model
+from bop.signals import deferred
 
 
 def get_model_perms(model):
@@ -81,7 +93,12 @@ def iterify(obj, exceptions=(basestring,)):
     return [obj]
         
 
-def resolve(iterable, model, key=None):
+def resolve(iterable, model, key=None, memo=None):
+    """ Turns (an iterable of) model-instances, pks, strings and
+    lookup-dicts into a list of model-instances
+
+    Lookups are remembered in `memo` (a dict), if given.
+    """
     resolved = []
     for i in iterify(iterable):
         if isinstance(i, model):
@@ -94,10 +111,18 @@ def resolve(iterable, model, key=None):
             else:
                 i = {key: i}
         if isinstance(i, dict):
+            lookup = (model, tuple(sorted(i.items())))
+            if memo is not None and lookup in memo:
+                if memo[lookup] is not None:
+                    resolved.append(memo[lookup])
+                continue
             try:
-                resolved.append(model.objects.get(**i))
+                obj = model.objects.get(**i)
+                resolved.append(obj)
             except model.DoesNotExist:
-                pass
+                obj = None
+            if memo is not None:
+                memo[lookup] = obj
     return resolved
 
 
@@ -116,18 +141,23 @@ def perm2dict(perm):
     return {"content_type__app_label": app_label, "codename": codename}
 
 
-def _make_lists_of_objects(users, groups, permissions, objects):
+def _make_lists_of_objects(users, groups, permissions, objects, memo=None):
     # Make sure all 'objects' are model-instances
-    users = resolve(users, User, key='username')
-    groups = resolve(groups, Group, key='name')
-    permissions = resolve(permissions, Permission, key=perm2dict)
+    users = resolve(users, User, key='username', memo=memo)
+    groups = resolve(groups, Group, key='name', memo=memo)
+    permissions = resolve(permissions, Permission, key=perm2dict, memo=memo)
     # objects *must* be model-instances already
     return (users, groups, permissions, iterify(objects))
 
 
-def grant(users, groups, permissions, objects):
+def _permission_keys(users, groups, permissions, objects, memo=None):
+    """ Returns the PermissionKeys for all combinations of users and
+    groups, permissions and objects (skipping permissions that do not
+    apply to an object)
+    """
     users, groups, permissions, objects = \
-        _make_lists_of_objects(users, groups, permissions, objects)
+        _make_lists_of_objects(users, groups, permissions, objects, memo)
+    keys = []
     for o in objects:
         if not hasattr(o, '_meta'):
             continue
@@ -135,35 +165,274 @@ def grant(users, groups, permissions, objects):
         for p in permissions:
             if is_object_permission(o, p, ct):
                 for u in users:
-                    ObjectPermission.objects.get_or_create(user=u,
-                                                           permission=p,
-                                                           object_id=o.id,
-                                                           content_type=ct)
+                    keys.append(PermissionKey(ct.pk, o.pk, p.pk, u.pk, None))
                 for g in groups:
-                    ObjectPermission.objects.get_or_create(group=g,
-                                                           permission=p,
-                                                           object_id=o.id,
-                                                           content_type=ct)
+                    keys.append(PermissionKey(ct.pk, o.pk, p.pk, None, g.pk))
+    return keys
+
+
+def get_subject(user):
+    """ Returns the User whose ObjectPermissions apply to `user`
+
+    That is the user itself or, for anonymous users, the user with
+    settings.ANONYMOUS_USER_ID (or None).
+    """
+    if user.is_anonymous():
+        try:
+            return User.objects.get(pk=settings.ANONYMOUS_USER_ID)
+        except (AttributeError, User.DoesNotExist):
+            return None
+    return user
+
+
+def filter_permitted(user, perm, objects, check_model_perms=False,
+                     chunk_size=500):
+    """ Returns the objects on which `user` has `perm`
+
+    `objects` can be any iterable of model instances (of different
+    models). The objects are grouped by content type and each group is
+    checked with a single query. The result is in the original order.
+
+    >>> things = filter_permitted(request.user, 'myapp.view_thing', things)
+
+    Like ObjectBackend only ObjectPermissions are checked, unless
+    check_model_perms is True: then a user with the (model) permission
+    gets all objects.
+    """
+    objects = list(objects)
+    if user.is_active and user.is_superuser:
+        return objects
+    if check_model_perms and user.has_perm(perm):
+        return objects
+    subject = get_subject(user)
+    if subject is None or not subject.is_active:
+        return []
+    app_label, codename = perm.split('.')
+    object_ids = {}
+    for o in objects:
+        if isinstance(o, models.Model):
+            ct = ContentType.objects.get_for_model(o)
+            if ct.app_label == app_label:
+                object_ids.setdefault(ct, set()).add(o.pk)
+    permitted = set()
+    for ct, ids in object_ids.items():
+        if preload_enabled():
+            permitted.update((ct.pk, pk) for pk in ids if perm in
+                             get_indexed_permissions(subject, ct, pk))
+            continue
+        ids = list(ids)
+        model = get_permission_model(ct.model_class())
+        for i in range(0, len(ids), chunk_size):
+            permitted.update((ct.pk, pk) for pk in evaluate(
+                    model.objects.filter_objects(
+                        ct.pk, ids[i:i+chunk_size]).filter(
+                        Q(user=subject) | Q(group__in=get_user_group_ids(subject)),
+                        permission__codename=codename
+                        ).values_list(model.object_field, flat=True),
+                    'filter_permitted'))
+    return [o for o in objects if isinstance(o, models.Model) and
+            (ContentType.objects.get_for_model(o).pk, o.pk) in permitted]
+
+
+def count_user_objects(user, model, permissions=None):
+    """ Returns the number of objects of `model` `user` has permissions
+    on (optionally only counting specific permissions)
+
+    The count is the same as model.objects.get_user_objects(user,
+    permissions).count() but it is cached until permissions of the user
+    (or one of the user's groups) change. Note that deleting objects
+    only updates the count when their ObjectPermissions are deleted
+    too (see bop.models.remove_object_permissions).
+    """
+    if user.is_superuser:
+        return model._default_manager.count()
+    subject = get_subject(user)
+    if subject is None:
+        return 0
+    if permissions:
+        permissions = resolve(permissions, Permission, perm2dict)
+    ct = ContentType.objects.get_for_model(model)
+    key = 'bop:count:%s:%s:%s' % (subject.pk, ct.pk, md5(','.join(
+                sorted([str(p.pk) for p in permissions or []]))).hexdigest())
+    def count():
+        ops = get_permission_model(model).objects.get_for_model_and_user(
+            model, subject)
+        if permissions:
+            ops = ops.filter(permission__in=permissions)
+        return evaluate(model._default_manager.filter(
+                pk__in=ops.values(ops.model.object_field)), 'count_user_objects',
+                        lambda queryset: queryset.count())
+    return get_versioned(key, get_user_version(subject), count)
+
+
+def _keys_by_model(keys):
+    """ Groups PermissionKeys by the model that stores them """
+    by_model = {}
+    for key in keys:
+        model = get_permission_model(ContentType.objects.get_for_id(
+                key.content_type_id).model_class())
+        by_model.setdefault(model, []).append(key)
+    return by_model
+
+
+def _insert_keys(keys):
+    """ Inserts the PermissionKeys that do not exist yet and returns
+    the ones that were inserted
+    """
+    added = []
+    for model, keys in _keys_by_model(keys).items():
+        added.extend(permission_key(op) for op in model.objects.bulk_insert(
+                [model.from_key(key) for key in keys]))
+    return added
+
+
+def _delete_keys(keys):
+    """ Deletes the PermissionKeys and returns the ones that existed """
+    removed = []
+    for model, keys in _keys_by_model(keys).items():
+        removed.extend(model.objects.delete_keys(keys))
+    return removed
+
+
+_batch = threading.local()
+
+
+class Batch(object):
+    """ Grants and revokes collected by bop.api.batch """
+
+    def __init__(self):
+        # PermissionKey -> True (grant) or False (revoke)
+        self.operations = {}
+        # Remembers users, groups and permissions resolve looked up
+        self.memo = {}
+        self.added = []
+        self.removed = []
+
+    def add(self, keys, granted):
+        for key in keys:
+            # The last grant/revoke of a key wins
+            self.operations[key] = granted
+
+    def flush(self):
+        grants = [key for key, granted in self.operations.items() if granted]
+        revokes = [key for key, granted in self.operations.items()
+                   if not granted]
+        self.operations = {}
+        with deferred():
+            with atomic():
+                self.removed.extend(_delete_keys(revokes))
+                self.added.extend(_insert_keys(grants))
+
+
+@contextmanager
+def batch():
+    """ Collects all grants and revokes in the block and applies them
+    at the end with a few bulk statements (in one transaction)
+
+    with batch() as b:
+        for thing in things:
+            grant(testuser, None, 'myapp.change_thing', thing)
+            revoke(testuser, None, 'myapp.delete_thing', thing)
+    # b.added and b.removed are the PermissionKeys that changed
+
+    Granting and revoking the same permission cancel out (the last one
+    wins). permissions_changed is sent once. Nothing is applied if the
+    block raises an exception. Nested batches are part of the outermost
+    batch.
+    """
+    current = getattr(_batch, 'current', None)
+    if current is not None:
+        yield current
+        return
+    _batch.current = current = Batch()
+    try:
+        yield current
+    finally:
+        _batch.current = None
+    current.flush()
+
+
+def grant(users, groups, permissions, objects):
+    current = getattr(_batch, 'current', None)
+    keys = _permission_keys(users, groups, permissions, objects,
+                            current and current.memo)
+    if current is not None:
+        current.add(keys, True)
+    else:
+        # The change log is written in the same transaction
+        with deferred():
+            with atomic():
+                _insert_keys(keys)
     
 
 def revoke(users, groups, permissions, objects):
-    users, groups, permissions, objects = \
-        _make_lists_of_objects(users, groups, permissions, objects)
-    userlist = []
-    grouplist = []
+    current = getattr(_batch, 'current', None)
+    keys = _permission_keys(users, groups, permissions, objects,
+                            current and current.memo)
+    if current is not None:
+        current.add(keys, False)
+    else:
+        # The change log is written in the same transaction
+        with deferred():
+            with atomic():
+                _delete_keys(keys)
+
+
+def set_permissions(objects, grants, chunk_size=500):
+    """ Makes the ObjectPermissions of `objects` exactly `grants`
+
+    `grants` maps users and groups (instances) to permissions:
+
+      set_permissions(myobject, {testuser: ['myapp.change_mymodel'],
+                                 testgroup: ['myapp.view_mymodel']})
+
+    The current ObjectPermissions are read in bulk and only the
+    difference is applied (in one transaction). Users and groups that
+    are not in `grants` lose their permissions on the objects.
+
+    Returns a tuple of two lists: the PermissionKeys that were added
+    and those that were removed.
+    """
+    objects = [o for o in iterify(objects) if hasattr(o, '_meta')]
+    wanted = set()
+    for subject, permissions in grants.items():
+        if isinstance(subject, User):
+            user_id, group_id = subject.pk, None
+        elif isinstance(subject, Group):
+            user_id, group_id = None, subject.pk
+        else:
+            raise TypeError("Expected a User or a Group, not %r" % subject)
+        permissions = resolve(permissions, Permission, key=perm2dict)
+        for o in objects:
+            ct = ContentType.objects.get_for_model(o)
+            for p in permissions:
+                if is_object_permission(o, p, ct):
+                    wanted.add(PermissionKey(ct.pk, o.pk, p.pk, user_id, group_id))
+    # (permission model, content_type.pk) -> object ids
+    object_ids = {}
     for o in objects:
         ct = ContentType.objects.get_for_model(o)
-        for p in permissions:
-            if is_object_permission(o, p, ct):
-                for u in users:
-                    userlist.append(Q(user=u))
-                for g in groups:
-                    grouplist.append(Q(group=g))
-                Qs = userlist+grouplist
-                if not Qs:
-                    continue
-                ObjectPermission.objects.filter(
-                    reduce(operator.or_, Qs),
-                    content_type=ct, object_id=o.id,permission=p
-                    ).delete()
-
+        object_ids.setdefault((get_permission_model(o), ct.pk), set()).add(o.pk)
+    # deferred outside atomic: the caches hear about it after the commit
+    # (and again after the commit of an outer transaction)
+    with deferred():
+        with atomic():
+            # PermissionKey -> (permission model, pk)
+            current = {}
+            for (model, ct_id), ids in object_ids.items():
+                ids = list(ids)
+                for i in range(0, len(ids), chunk_size):
+                    for pk, key in model.objects.keys(model.objects.filter_objects(
+                            ct_id, ids[i:i+chunk_size])):
+                        current[key] = (model, pk)
+            pks = {}
+            for key, (model, pk) in current.items():
+                if key not in wanted:
+                    pks.setdefault(model, []).append(pk)
+            removed = []
+            for model, model_pks in pks.items():
+                for i in range(0, len(model_pks), chunk_size):
+                    removed.extend(model.objects.bulk_delete(
+                            model.objects.filter(pk__in=model_pks[i:i+chunk_size])))
+            added = _insert_keys([key for key in wanted if key not in current])
+    return added, removed
@@ -6,8 +6,13 @@ from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models import Q
 
-from bop.api import get_model_perms
-from bop.models import ObjectPermission
+from bop.caches import membership_enabled, has_object_permissions, \
+    preload_enabled, get_indexed_permissions, get_user_group_ids, \
+    get_user_version, get_versioned
+from bop.diagnostics import evaluate
+from bop.models import ObjectPermission, get_permission_model, \
+    get_permission_models
+from bop.snapshot import get_snapshot
 
 
 class AnonymousModelBackend(object):
@@ -95,14 +100,20 @@ class ObjectBackend(object):
         if not isinstance(obj, models.Model):
             return ObjectPermission.objects.none()
         ct = ContentType.objects.get_for_model(obj)
-        return ObjectPermission.objects.filter(
-            content_type=ct, object_id=obj.pk)
+        model = get_permission_model(obj)
+        if model is ObjectPermission and isinstance(obj.pk, (int, long)) and \
+                membership_enabled(ct) and not has_object_permissions(ct, obj.pk):
+            return ObjectPermission.objects.none()
+        return model.objects.filter_objects(ct.pk, [obj.pk])
 
-    def _listify(self, perms):
-        perms = perms.values_list(
-            'content_type__app_label', 
-            'permission__codename')
-        return set(["%s.%s" % (ct, name) for ct, name in perms])
+    def _listify(self, perms, obj):
+        # All perms are on obj, so they share its app_label (no join)
+        if not isinstance(obj, models.Model):
+            return set()
+        app_label = ContentType.objects.get_for_model(obj).app_label
+        perms = evaluate(perms.values_list('permission__codename', flat=True),
+                         'ObjectBackend')
+        return set(["%s.%s" % (app_label, name) for name in perms])
 
     def get_all_permissions(self, user_obj, obj=None):
         if obj is None:
@@ -110,9 +121,17 @@ class ObjectBackend(object):
         if user_obj.is_anonymous():
             user_obj = self.user_obj
         if user_obj and user_obj.is_active:
+            if isinstance(obj, models.Model) and isinstance(obj.pk, (int, long)):
+                ct = ContentType.objects.get_for_model(obj)
+                snapshot = get_snapshot(ct)
+                if snapshot is not None:
+                    return snapshot.get_permissions(
+                        user_obj.pk, get_user_group_ids(user_obj), obj.pk)
+                if preload_enabled():
+                    return get_indexed_permissions(user_obj, ct, obj.pk)
             return self._listify(self._get_obj_perms(user_obj, obj).filter(
-                    Q(group__in=user_obj.groups.all())|
-                    Q(user=user_obj)))
+                    Q(group__in=get_user_group_ids(user_obj))|
+                    Q(user=user_obj)), obj)
         return set()
 
     def get_group_permissions(self, user_obj, obj=None):
@@ -122,31 +141,51 @@ class ObjectBackend(object):
             user_obj = self.user_obj
         if user_obj and user_obj.is_active:
             return self._listify(self._get_obj_perms(user_obj, obj).filter(
-                    group__in=user_obj.groups.all()))
+                    group__in=get_user_group_ids(user_obj)), obj)
         return set()
 
     def has_perm(self, user_obj, perm, obj=None):
         return perm in self.get_all_permissions(user_obj, obj)
 
+    def _has_object_perms(self, user_obj, key, querysets):
+        """ Does user_obj have any of the ObjectPermissions in the
+        querysets that querysets() returns?
+
+        Each queryset costs one EXISTS query and the answer is cached
+        until the permissions of the user change.
+        """
+        if user_obj.is_anonymous():
+            user_obj = self.user_obj
+        if not user_obj or not user_obj.is_active:
+            return False
+        def exists():
+            for ops in querysets():
+                if evaluate(ops.filter(
+                        Q(user=user_obj) | Q(group__in=get_user_group_ids(user_obj))),
+                            'ObjectBackend', lambda ops: ops.exists()):
+                    return True
+            return False
+        return get_versioned('bop:%s:%s' % (key, user_obj.pk),
+                             get_user_version(user_obj), exists)
+
     def has_model_perms(self, user_obj, model):
         """
-        Returns True if user_obj has any permissions in the given model
+        Returns True if user_obj has any ObjectPermission on any object
+        of the given model
         """
-        for perm in self.get_all_permissions(user_obj):
-            app_label, codename = perm.split('.')
-            if model._meta.app_label == app_label and \
-                    codename in get_model_perms(model):
-                return True
-        return False
+        ct = ContentType.objects.get_for_model(model)
+        return self._has_object_perms(
+            user_obj, 'model_perms:%s' % ct.pk, lambda: [
+                get_permission_model(model).objects.get_for_model(model)])
 
     def has_module_perms(self, user_obj, app_label):
         """
-        Returns True if user_obj has any permissions in the given app_label.
-
-        Note: If this backend is used, as recommended, in conjunction
-        with ModelBackend then this method wil never be called.
+        Returns True if user_obj has any ObjectPermission on any object
+        in the given app_label (so the app shows up on the admin index)
         """
-        for perm in self.get_all_permissions(user_obj):
-            if perm[:perm.index('.')] == app_label:
-                return True
-        return False
+        return self._has_object_perms(
+            user_obj, 'module_perms:%s' % app_label, lambda: [
+                model.objects.get_for_app(app_label)
+                for model in get_permission_models()
+                if model is ObjectPermission or
+                model.get_content_type().app_label == app_label])
@@ -0,0 +1,235 @@
+""" Caches in front of the ObjectPermission table
+
+All caches are versioned. A version is a random token stored in the
+(shared) cache. Changing it invalidates every cached value that was
+built for the previous version, in this process and in all others.
+"""
+from array import array
+from bisect import bisect_left
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth.models import User
+try:
+    from django.contrib.auth.signals import user_logged_in
+except ImportError: # Django < 1.3
+    user_logged_in = None
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import m2m_changed
+
+from bop.groups import get_ancestor_ids, nested_groups_enabled
+from bop.models import ObjectPermission, get_permission_models
+from bop.signals import permissions_changed
+
+
+def _timeout():
+    return getattr(settings, 'BOP_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def get_version(key):
+    """ Returns the current version stored under `key` """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, _timeout())
+        version = cache.get(key)
+    return version
+
+
+def bump_versions(keys):
+    """ Gives each of `keys` a new version """
+    if keys:
+        cache.set_many(dict((key, uuid4().hex) for key in keys), _timeout())
+
+
+def get_versioned(key, version, build):
+    """ Returns the value cached under `key` for `version`; calls build()
+    (and caches the result) if there is none
+    """
+    cached = cache.get(key)
+    if cached is None or cached[0] != version:
+        cached = (version, build())
+        cache.set(key, cached, _timeout())
+    return cached[1]
+
+
+# Membership: which objects have any ObjectPermissions at all?
+
+# content_type.pk -> (version, array of object_ids)
+_members = {}
+
+
+def _members_key(ct_id):
+    return 'bop:members:%s' % ct_id
+
+
+def membership_enabled(content_type):
+    """ Is the membership cache switched on for `content_type`?
+
+    BOP_MEMBERSHIP_CACHE is either a boolean or a list of app_label.model
+    """
+    enabled = getattr(settings, 'BOP_MEMBERSHIP_CACHE', False)
+    if isinstance(enabled, (list, tuple)):
+        return "%s.%s" % (content_type.app_label,
+                          content_type.model) in enabled
+    return bool(enabled)
+
+
+def has_object_permissions(content_type, object_id):
+    """ Returns False if there are no ObjectPermissions for the object
+
+    A sorted array with the object_ids of `content_type` that have
+    ObjectPermissions is kept in this process and in the shared cache,
+    so for most objects this costs a single cache lookup (of the
+    version). Revoking does not remove ids from the array: a stale id
+    only costs a query, a missing one would hide permissions.
+    """
+    key = _members_key(content_type.pk)
+    version = get_version(key + ':version')
+    members = _members.get(content_type.pk)
+    if members is None or members[0] != version:
+        members = cache.get(key)
+        if members is None or members[0] != version:
+            object_ids = ObjectPermission.objects.filter(
+                content_type=content_type).order_by('object_id').values_list(
+                'object_id', flat=True).distinct()
+            members = (version, array('L', object_ids))
+            cache.set(key, members, _timeout())
+        _members[content_type.pk] = members
+    object_ids = members[1]
+    i = bisect_left(object_ids, object_id)
+    return i < len(object_ids) and object_ids[i] == object_id
+
+
+# Users: everything that depends on the permissions of one user
+
+def _user_key(user_id):
+    return 'bop:user:%s' % user_id
+
+
+def _group_key(group_id):
+    return 'bop:group:%s' % group_id
+
+
+_NESTING_KEY = 'bop:nesting:version'
+
+
+def bump_nesting_version():
+    """ Invalidates the groups of all users (after the nesting changed) """
+    bump_versions([_NESTING_KEY])
+
+
+def _build_user_group_ids(user):
+    group_ids = list(user.groups.values_list('pk', flat=True))
+    return tuple(set(group_ids + get_ancestor_ids(group_ids)))
+
+
+def get_user_group_ids(user):
+    """ Returns the ids of the groups of `user` (and, with nested groups,
+    of the groups they are nested in)
+    """
+    key = _user_key(user.pk)
+    keys = [key + ':version', key + ':groups']
+    if nested_groups_enabled():
+        keys.append(_NESTING_KEY)
+    cached = cache.get_many(keys)
+    version = ':'.join([cached.get(k) or get_version(k)
+                        for k in keys if k != key + ':groups'])
+    groups = cached.get(key + ':groups')
+    if groups is not None and groups[0] == version:
+        return groups[1]
+    return get_versioned(key + ':groups', version,
+                         lambda: _build_user_group_ids(user))
+
+
+def get_user_version(user):
+    """ Returns a version that changes whenever ObjectPermissions of
+    `user`, or of one of the user's groups, or the user's groups change
+    """
+    keys = [_user_key(user.pk) + ':version'] + \
+        [_group_key(g) + ':version' for g in get_user_group_ids(user)]
+    if nested_groups_enabled():
+        keys.append(_NESTING_KEY)
+    versions = cache.get_many(keys)
+    return ':'.join([versions.get(key) or get_version(key) for key in keys])
+
+
+def _build_user_index(user):
+    index = {}
+    for model in get_permission_models():
+        ops = model.objects.filter(
+            Q(user=user) | Q(group__in=get_user_group_ids(user)))
+        for ct_id, object_id, app_label, codename in ops.values_list(
+                'permission__content_type', model.object_field,
+                'permission__content_type__app_label', 'permission__codename'):
+            perms, objects = index.setdefault(ct_id, ([], {}))
+            label = "%s.%s" % (app_label, codename)
+            if label not in perms:
+                perms.append(label)
+            objects[object_id] = objects.get(object_id, 0) | \
+                1 << perms.index(label)
+    return index
+
+
+def get_user_index(user):
+    """ Returns all ObjectPermissions of `user` (direct and via groups)
+
+    The index maps content_type.pk to a tuple with a list of
+    permissions ('app_label.codename') and a dict that maps object_id
+    to a bitset of the positions (in the list) of the permissions the
+    user has on the object.
+    """
+    version = get_user_version(user)
+    cached = getattr(user, '_bop_index', None)
+    if cached is None or cached[0] != version:
+        cached = (version, get_versioned(_user_key(user.pk) + ':index',
+                                         version,
+                                         lambda: _build_user_index(user)))
+        user._bop_index = cached
+    return cached[1]
+
+
+def get_indexed_permissions(user, content_type, object_id):
+    """ Returns the permissions of `user` on an object from the index """
+    perms, objects = get_user_index(user).get(content_type.pk, ((), {}))
+    bits = objects.get(object_id, 0)
+    return set([perm for i, perm in enumerate(perms) if bits & 1 << i])
+
+
+def preload_enabled():
+    return getattr(settings, 'BOP_PRELOAD_PERMISSIONS', False)
+
+
+def _preload(sender, request, user, **kwargs):
+    if preload_enabled():
+        get_user_index(user)
+
+
+def _groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+    elif pk_set:
+        user_ids = pk_set
+    else:
+        user_ids = instance.user_set.values_list('pk', flat=True)
+    bump_versions([_user_key(pk) + ':version' for pk in user_ids])
+
+
+def _invalidate(sender, added, removed, **kwargs):
+    keys = set(_members_key(key.content_type_id) + ':version'
+               for key in added)
+    for key in added + removed:
+        if key.user_id:
+            keys.add(_user_key(key.user_id) + ':version')
+        if key.group_id:
+            keys.add(_group_key(key.group_id) + ':version')
+    bump_versions(keys)
+
+
+permissions_changed.connect(_invalidate, dispatch_uid='bop.caches._invalidate')
+m2m_changed.connect(_groups_changed, sender=User.groups.through,
+                    dispatch_uid='bop.caches._groups_changed')
+if user_logged_in is not None:
+    user_logged_in.connect(_preload, dispatch_uid='bop.caches._preload')
@@ -0,0 +1,98 @@
+""" Change log of grants and revokes
+
+With BOP_CHANGE_LOG = True every change to ObjectPermissions (grant,
+revoke, set_permissions, batches, the admin, formsets, saving and
+deleting ObjectPermissions) is appended to ObjectPermissionChange, in
+the transaction that made the change. Its pk is a global version that
+only goes up, so caches can ask what changed since the version they
+were built for::
+
+  changes = changes_since(version, content_type)
+
+Versions are handed out when a change is written, not when it is
+committed, so a change can show up after changes with a higher version.
+recent_changes also returns the changes of the last few seconds to
+catch those.
+
+Old changes are removed with './manage.py bop_prune_changes'.
+"""
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Max, Min, Q
+
+from bop.models import ObjectPermissionChange
+from bop.signals import permissions_written
+
+
+def changelog_enabled():
+    return getattr(settings, 'BOP_CHANGE_LOG', False)
+
+
+def current_version():
+    """ Returns the version of the latest change (0 if there are none) """
+    return ObjectPermissionChange.objects.aggregate(
+        latest=Max('pk'))['latest'] or 0
+
+
+def version_range():
+    """ Returns the versions of the oldest and the latest change in the
+    log (0, 0 if it is empty)
+    """
+    versions = ObjectPermissionChange.objects.aggregate(
+        oldest=Min('pk'), latest=Max('pk'))
+    return versions['oldest'] or 0, versions['latest'] or 0
+
+
+def changes_since(version, content_type=None):
+    """ Returns the changes after `version` (optionally only those of
+    `content_type`), oldest first
+
+    The changes are ObjectPermissionChanges: change.key is the
+    PermissionKey, change.added tells a grant from a revoke.
+    """
+    changes = ObjectPermissionChange.objects.filter(pk__gt=version)
+    if content_type is not None:
+        changes = changes.filter(content_type=content_type)
+    return changes.order_by('pk')
+
+
+def _window():
+    return getattr(settings, 'BOP_CHANGE_LOG_WINDOW', 60)
+
+
+def recent_changes(version, content_type=None, seconds=None):
+    """ Returns the changes after `version` and those written in the
+    last `seconds` (default BOP_CHANGE_LOG_WINDOW, 60), oldest first
+
+    The latter may have been committed after the changes up to
+    `version` were read; callers skip the ones they already saw.
+    """
+    if seconds is None:
+        seconds = _window()
+    since = datetime.now() - timedelta(seconds=seconds)
+    changes = ObjectPermissionChange.objects.filter(
+        Q(pk__gt=version) | Q(created__gte=since))
+    if content_type is not None:
+        changes = changes.filter(content_type=content_type)
+    return changes.order_by('pk')
+
+
+def _record_changes(sender, added, removed, **kwargs):
+    # Sent in the transaction that changed the ObjectPermissions, so the
+    # log is committed (or rolled back) with them
+    if not changelog_enabled():
+        return
+    changes = [ObjectPermissionChange(added=False, **key._asdict())
+               for key in removed] + \
+        [ObjectPermissionChange(added=True, **key._asdict())
+         for key in added]
+    if hasattr(ObjectPermissionChange.objects, 'bulk_create'):
+        ObjectPermissionChange.objects.bulk_create(changes)
+    else: # Django < 1.4
+        for change in changes:
+            change.save(force_insert=True)
+
+
+permissions_written.connect(_record_changes,
+                            dispatch_uid='bop.changelog._record_changes')
@@ -0,0 +1,63 @@
+""" Logging of slow permission checks
+
+Switched on by setting BOP_SLOW_CHECK_MS: checks that take at least
+that many milliseconds are logged (to the 'bop.slow' logger) with their
+SQL, parameters and query plan. BOP_SLOW_CHECK_SAMPLE_RATE (0.0 - 1.0,
+default 1.0) limits the fraction of checks that is timed.
+"""
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+
+
+logger = logging.getLogger('bop.slow')
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+def explain(queryset):
+    """ Returns the SQL, the parameters and the query plan (or None if
+    the database has no EXPLAIN bop knows about) for `queryset`
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    prefix = EXPLAIN.get(connection.vendor)
+    if prefix is None:
+        return sql, params, None
+    # A failed statement aborts the transaction on PostgreSQL; the
+    # savepoint keeps the rest of the request working
+    sid = transaction.savepoint(using=queryset.db)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(prefix + sql, params)
+        plan = '\n'.join([' '.join([unicode(column) for column in row])
+                          for row in cursor.fetchall()])
+    except DatabaseError as e:
+        transaction.savepoint_rollback(sid, using=queryset.db)
+        plan = 'EXPLAIN failed: %s' % e
+    else:
+        transaction.savepoint_commit(sid, using=queryset.db)
+    return sql, params, plan
+
+
+def evaluate(queryset, label, evaluate=list):
+    """ Returns evaluate(queryset), logging the query if it is slow """
+    threshold = getattr(settings, 'BOP_SLOW_CHECK_MS', None)
+    if threshold is None or \
+            random.random() >= getattr(settings, 'BOP_SLOW_CHECK_SAMPLE_RATE', 1.0):
+        return evaluate(queryset)
+    start = time.time()
+    result = evaluate(queryset)
+    elapsed = (time.time() - start) * 1000
+    if elapsed >= threshold:
+        sql, params, plan = explain(queryset)
+        logger.warning("Slow permission check in %s: %.1fms\n%s\n%r\n%s",
+                       label, elapsed, sql, params, plan)
+    return result
@@ -1,24 +1,147 @@
-from django.contrib.auth.models import Permission
-from django.contrib.contenttypes.generic import generic_inlineformset_factory
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.generic import generic_inlineformset_factory, \
+    BaseGenericInlineFormSet
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.validators import EMPTY_VALUES
+from django.db.models import signals
 from django import forms
 
 from bop.models import ObjectPermission
 
 
+# content_type.pk -> [Permission, ...]
+_permissions_cache = {}
+
+
+def get_permissions(content_type):
+    """ Returns the list of Permissions for `content_type`
+
+    The list is built once per content type and process and cleared
+    whenever a Permission is saved or deleted.
+    """
+    try:
+        return _permissions_cache[content_type.pk]
+    except KeyError:
+        permissions = list(Permission.objects.filter(
+                content_type=content_type).select_related('content_type'))
+        _permissions_cache[content_type.pk] = permissions
+        return permissions
+
+
+def clear_permissions_cache(sender, **kwargs):
+    _permissions_cache.clear()
+
+
+signals.post_save.connect(clear_permissions_cache, sender=Permission,
+                          dispatch_uid='bop.forms.clear_permissions_cache')
+signals.post_delete.connect(clear_permissions_cache, sender=Permission,
+                            dispatch_uid='bop.forms.clear_permissions_cache')
+
+
+class PermissionChoiceField(forms.ModelChoiceField):
+    """ A ModelChoiceField for the Permissions of one content type
+
+    The choices come from get_permissions so rendering and cleaning the
+    field does not hit the database.
+    """
+    def __init__(self, content_type, *args, **kwargs):
+        self.content_type = content_type
+        kwargs['queryset'] = Permission.objects.filter(content_type=content_type)
+        super(PermissionChoiceField, self).__init__(*args, **kwargs)
+
+    def _get_choices(self):
+        choices = [(p.pk, self.label_from_instance(p))
+                   for p in get_permissions(self.content_type)]
+        if self.empty_label is not None:
+            choices.insert(0, (u"", self.empty_label))
+        return choices
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+    def to_python(self, value):
+        if value in EMPTY_VALUES:
+            return None
+        for permission in get_permissions(self.content_type):
+            if unicode(permission.pk) == unicode(value):
+                return permission
+        raise ValidationError(self.error_messages['invalid_choice'])
+
+
+class ObjectPermissionFormSet(BaseGenericInlineFormSet):
+    """ Saves the inline ObjectPermissions as a diff
+
+    Deleted rows are removed with one query and new rows are inserted
+    in batches (skipping rows that already exist).
+    """
+    def save(self, commit=True):
+        if not commit:
+            return super(ObjectPermissionFormSet, self).save(commit)
+        deleted = self.can_delete and self.deleted_forms or []
+        self.deleted_objects = [f.instance for f in deleted if f.instance.pk]
+        self.changed_objects = []
+        saved = []
+        for form in self.initial_forms:
+            if form in deleted or not form.has_changed():
+                continue
+            saved.append(form.save())
+            self.changed_objects.append((saved[-1], form.changed_data))
+        new = []
+        ct = ContentType.objects.get_for_model(self.instance)
+        for form in self.extra_forms:
+            if form in deleted or not form.has_changed():
+                continue
+            obj = form.save(commit=False)
+            setattr(obj, self.ct_field.get_attname(), ct.pk)
+            setattr(obj, self.ct_fk_field.get_attname(), self.instance.pk)
+            new.append(obj)
+        if self.deleted_objects:
+            ObjectPermission.objects.bulk_delete(ObjectPermission.objects.filter(
+                    pk__in=[o.pk for o in self.deleted_objects]))
+        self.new_objects = ObjectPermission.objects.bulk_insert(new)
+        return saved + self.new_objects
+
+
+def permissions_formfield_callback(model):
+    """ Returns a formfield_callback that limits the permission field
+    to the permissions of `model`
+    """
+    ct = ContentType.objects.get_for_model(model)
+    def formfield_callback(field, *args, **kwargs):
+        if field.name == 'permission':
+            return PermissionChoiceField(ct, required=not field.blank)
+        return field.formfield(*args, **kwargs)
+    return formfield_callback
+
+
 def inline_permissions_form_factory(model, extra=1):
     """ Returns a modelformset for ObjectPermission linked to <model>
 
     InlinePermissionForm = inline_permissions_form_factory(MyModel)
     # myobject is an instance of MyModel
-    form = MyModelForm(instance=myobject) 
+    form = MyModelForm(instance=myobject)
     formset = InlinePermissionForm(instance=myobject)
     """
-    def formfield_callback(field, *args):
-        ct = ContentType.objects.get_for_model(model)
-        if field.name == 'permission':
-            return field.formfield(
-                queryset=Permission.objects.filter(content_type=ct))
-        return field.formfield()
     return generic_inlineformset_factory(
-        ObjectPermission, extra=extra, formfield_callback=formfield_callback)
+        ObjectPermission, formset=ObjectPermissionFormSet, extra=extra,
+        formfield_callback=permissions_formfield_callback(model))
+
+
+class BulkPermissionForm(forms.Form):
+    """ Chooses the users, groups and permissions (of `model`) to grant
+    or revoke on many objects at once
+    """
+    users = forms.ModelMultipleChoiceField(User.objects.all(), required=False)
+    groups = forms.ModelMultipleChoiceField(Group.objects.all(), required=False)
+
+    def __init__(self, model, *args, **kwargs):
+        super(BulkPermissionForm, self).__init__(*args, **kwargs)
+        ct = ContentType.objects.get_for_model(model)
+        self.fields['permissions'] = forms.ModelMultipleChoiceField(
+            Permission.objects.filter(content_type=ct))
+
+    def clean(self):
+        data = self.cleaned_data
+        if not data.get('users') and not data.get('groups'):
+            raise ValidationError('Choose at least one user or group.')
+        return data
@@ -0,0 +1,152 @@
+""" Nested groups
+
+With BOP_NESTED_GROUPS = True a group can be nested in other groups
+(nest_group) and its members get the ObjectPermissions of all groups it
+is nested in, however deep. The transitive closure of the nesting is
+kept in GroupClosure so the groups of a user are always found with a
+single subquery.
+"""
+from __future__ import with_statement
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.db.models import Q
+from django.db.models.signals import pre_delete, post_delete
+
+from bop.managers import atomic
+from bop.models import GroupNesting, GroupClosure
+
+
+def nested_groups_enabled():
+    return getattr(settings, 'BOP_NESTED_GROUPS', False)
+
+
+def get_user_groups(user):
+    """ Returns the groups whose ObjectPermissions apply to `user`: the
+    user's groups and the groups they are nested in
+    """
+    groups = user.groups.all()
+    if not nested_groups_enabled():
+        return groups
+    return Group.objects.filter(
+        Q(pk__in=groups.values('pk')) |
+        Q(pk__in=GroupClosure.objects.filter(
+                descendant__in=groups.values('pk')).values('ancestor')))
+
+
+def get_ancestor_ids(group_ids):
+    """ Returns the ids of the groups `group_ids` are nested in """
+    if not nested_groups_enabled() or not group_ids:
+        return []
+    return list(GroupClosure.objects.filter(
+            descendant__in=group_ids).values_list('ancestor', flat=True))
+
+
+def get_member_groups(groups):
+    """ Returns the groups (a values('pk') queryset) whose members get
+    the ObjectPermissions of `groups` (a values('pk') queryset): the
+    groups themselves and the groups nested in them
+    """
+    if not nested_groups_enabled():
+        return groups
+    return Group.objects.filter(
+        Q(pk__in=groups) |
+        Q(pk__in=GroupClosure.objects.filter(
+                ancestor__in=groups).values('descendant'))).values('pk')
+
+
+def _closure(edges):
+    """ Returns {(ancestor, descendant): depth} for the (parent, child)
+    `edges`; raises ValueError if they make a cycle
+    """
+    parents = {}
+    for parent, child in edges:
+        parents.setdefault(child, set()).add(parent)
+    closure = {}
+    for group in parents:
+        depth, seen, frontier = 0, set([group]), set([group])
+        while frontier:
+            depth += 1
+            frontier = set([p for g in frontier for p in parents.get(g, ())])
+            if group in frontier:
+                raise ValueError("Group %s is nested in itself" % group)
+            frontier -= seen
+            seen |= frontier
+            for ancestor in frontier:
+                closure[(ancestor, group)] = depth
+    return closure
+
+
+def _rebuild_closure():
+    # Reads the nestings in the caller's transaction, so a nesting that
+    # a concurrent transaction committed in the meantime is checked too
+    wanted = _closure(GroupNesting.objects.values_list('parent', 'child'))
+    current = {}
+    for pk, ancestor, descendant, depth in GroupClosure.objects.values_list(
+            'pk', 'ancestor', 'descendant', 'depth'):
+        current[(ancestor, descendant)] = (pk, depth)
+    stale = [pk for key, (pk, depth) in current.items()
+             if wanted.get(key) != depth]
+    for i in range(0, len(stale), 500):
+        GroupClosure.objects.filter(pk__in=stale[i:i+500]).delete()
+    for (ancestor, descendant), depth in wanted.items():
+        if current.get((ancestor, descendant), (None, None))[1] != depth:
+            GroupClosure.objects.create(ancestor_id=ancestor,
+                                        descendant_id=descendant,
+                                        depth=depth)
+
+
+def rebuild_closure():
+    """ Brings GroupClosure in line with the GroupNestings (only the
+    rows that differ are written)
+    """
+    from bop.caches import bump_nesting_version
+    with atomic():
+        _rebuild_closure()
+    bump_nesting_version()
+
+
+def nest_group(parent, child):
+    """ Nests group `child` in group `parent` """
+    from bop.caches import bump_nesting_version
+    with atomic():
+        if parent.pk == child.pk or GroupClosure.objects.filter(
+                ancestor=child, descendant=parent).exists():
+            raise ValueError("Nesting '%s' in '%s' would make a cycle" % (
+                    child, parent))
+        GroupNesting.objects.get_or_create(parent=parent, child=child)
+        # Raises ValueError (and rolls back) if a concurrent nesting
+        # made a cycle with this one
+        _rebuild_closure()
+    bump_nesting_version()
+
+
+def unnest_group(parent, child):
+    """ Takes group `child` out of group `parent` """
+    from bop.caches import bump_nesting_version
+    with atomic():
+        GroupNesting.objects.filter(parent=parent, child=child).delete()
+        _rebuild_closure()
+    bump_nesting_version()
+
+
+def _group_deleting(sender, instance, **kwargs):
+    # The cascade deletes the group's GroupClosure rows before
+    # post_delete, so remember now whether it was nested at all
+    if not nested_groups_enabled():
+        return
+    instance._bop_nested = GroupClosure.objects.filter(
+        Q(ancestor=instance) | Q(descendant=instance)).exists()
+
+
+def _group_deleted(sender, instance, **kwargs):
+    # Groups nested in the deleted group are no longer nested in its
+    # ancestors
+    if getattr(instance, '_bop_nested', False):
+        rebuild_closure()
+
+
+pre_delete.connect(_group_deleting, sender=Group,
+                   dispatch_uid='bop.groups._group_deleting')
+post_delete.connect(_group_deleted, sender=Group,
+                    dispatch_uid='bop.groups._group_deleted')
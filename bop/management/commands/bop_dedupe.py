@@ -0,0 +1,72 @@
+from __future__ import with_statement
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Min
+
+from bop.models import ObjectPermission, get_permission_models
+from bop.signals import muted
+
+
+def key_fields(model):
+    """ Returns the fields that make an ObjectPermission of `model` unique """
+    if model is ObjectPermission:
+        return ('content_type', 'object_id', 'permission', 'user', 'group')
+    return ('object', 'permission', 'user', 'group')
+
+
+def duplicates(model):
+    """ Returns a dict for every set of rows of `model` with the same key,
+    with the key fields, the number of rows (n) and the lowest pk (keep)
+    """
+    fields = key_fields(model)
+    return model.objects.values(*fields).annotate(
+        n=Count('id'), keep=Min('id')).filter(n__gt=1).order_by('keep')
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only report the number of duplicates'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of sets of duplicates to merge at once'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+                    help='Seconds to sleep between chunks'),
+        )
+    help = ("Merges ObjectPermissions that grant the same permission on "
+            "the same object to the same user or group (keeping the oldest)")
+
+    def handle(self, *args, **options):
+        total = 0
+        for model in get_permission_models():
+            fields = key_fields(model)
+            label = model._meta.db_table
+            if options['dry_run']:
+                count = sum(d['n'] - 1 for d in duplicates(model))
+                self.stdout.write("%s: %d duplicates\n" % (label, count))
+                total += count
+                continue
+            deleted = 0
+            while True:
+                chunk = list(duplicates(model)[:options['chunk_size']])
+                if not chunk:
+                    break
+                pks = []
+                for duplicate in chunk:
+                    lookup = dict((field, duplicate[field]) for field in fields)
+                    pks.extend(model.objects.filter(**lookup).exclude(
+                            pk=duplicate['keep']).values_list('pk', flat=True))
+                # The key of every row that is kept still exists, so
+                # nothing changes for the caches
+                with muted():
+                    model.objects.filter(pk__in=pks).delete()
+                deleted += len(pks)
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+            self.stdout.write("%s: %d deleted\n" % (label, deleted))
+            total += deleted
+        self.stdout.write("Total: %d\n" % total)
@@ -0,0 +1,97 @@
+import csv
+import operator
+import sys
+import time
+from optparse import make_option
+
+try:
+    import json
+except ImportError: # Python < 2.6
+    from django.utils import simplejson as json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from bop.models import ObjectPermission
+
+
+# The natural keys of an ObjectPermission, in file order
+FIELDS = ('permission', 'content_type', 'object_id', 'user', 'group')
+
+FORMATS = ('jsonl', 'csv')
+
+
+def natural_keys(queryset, chunk_size=1000):
+    """ Yields a dict with the natural keys for each ObjectPermission in
+    `queryset`
+
+    The table is walked in primary key order, chunk_size rows at a time,
+    so memory use does not depend on the size of the table.
+    """
+    last = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last).order_by('pk').values_list(
+                'pk', 'permission__content_type__app_label',
+                'permission__codename', 'content_type__app_label',
+                'content_type__model', 'object_id', 'user__username',
+                'group__name')[:chunk_size])
+        if not rows:
+            return
+        for pk, perm_app, codename, ct_app, ct_model, object_id, \
+                username, groupname in rows:
+            yield {'permission': "%s.%s" % (perm_app, codename),
+                   'content_type': "%s.%s" % (ct_app, ct_model),
+                   'object_id': object_id,
+                   'user': username or '',
+                   'group': groupname or ''}
+        last = rows[-1][0]
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+                    help='Output format: jsonl (default) or csv'),
+        make_option('--output', '-o', dest='output', default=None,
+                    help='File to write to (default: stdout)'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of rows to fetch at once'),
+        )
+    help = ("Exports ObjectPermissions using natural keys")
+    args = '[app_label.model ...]'
+
+    def handle(self, *args, **options):
+        if options['format'] not in FORMATS:
+            raise CommandError("Unknown format '%s'" % options['format'])
+        queryset = ObjectPermission.objects.all()
+        if args:
+            content_types = []
+            for label in args:
+                try:
+                    app_label, model = label.split('.')
+                except ValueError:
+                    raise CommandError("Use app_label.model, not '%s'" % label)
+                content_types.append(Q(content_type__app_label=app_label,
+                                       content_type__model=model))
+            queryset = queryset.filter(reduce(operator.or_, content_types))
+        if options['output']:
+            stream = open(options['output'], 'wb')
+        else:
+            stream = sys.stdout
+        if options['format'] == 'csv':
+            writer = csv.writer(stream)
+            writer.writerow(FIELDS)
+            write = lambda row: writer.writerow(
+                [unicode(row[f]).encode('utf-8') for f in FIELDS])
+        else:
+            write = lambda row: stream.write(json.dumps(row) + '\n')
+        start = time.time()
+        count = 0
+        for row in natural_keys(queryset, options['chunk_size']):
+            write(row)
+            count += 1
+        if stream is not sys.stdout:
+            stream.close()
+        elapsed = max(time.time() - start, 0.001)
+        self.stderr.write("Exported %d rows in %.1fs (%d rows/s)\n" % (
+                count, elapsed, count / elapsed))
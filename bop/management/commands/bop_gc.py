@@ -0,0 +1,72 @@
+import time
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from bop.models import ObjectPermission
+
+
+def orphans(content_type):
+    """ Returns the ObjectPermissions of `content_type` whose object no
+    longer exists
+
+    The check is done in the database with an anti-join (NOT EXISTS)
+    against the table of the model. When the model itself is gone all
+    ObjectPermissions for the content type are orphans.
+    """
+    ops = ObjectPermission.objects.filter(content_type=content_type)
+    model = content_type.model_class()
+    if model is None:
+        return ops
+    qn = connection.ops.quote_name
+    opts = model._meta
+    return ops.extra(where=[
+            "NOT EXISTS (SELECT 1 FROM %s WHERE %s.%s = %s.object_id)" % (
+                qn(opts.db_table), qn(opts.db_table), qn(opts.pk.column),
+                qn(ObjectPermission._meta.db_table))])
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only report the number of orphans per content type'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of ObjectPermissions to delete at once'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+                    help='Seconds to sleep between chunks'),
+        )
+    help = ("Deletes ObjectPermissions whose objects no longer exist")
+    args = '[app_label.model ...]'
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        content_types = ContentType.objects.filter(
+            pk__in=ObjectPermission.objects.values('content_type'))
+        if args:
+            content_types = [ct for ct in content_types
+                             if "%s.%s" % (ct.app_label, ct.model) in args]
+        total = 0
+        for ct in content_types:
+            label = "%s.%s" % (ct.app_label, ct.model)
+            if options['dry_run']:
+                count = orphans(ct).count()
+                self.stdout.write("%s: %d orphaned\n" % (label, count))
+                total += count
+                continue
+            deleted = 0
+            while True:
+                ids = list(orphans(ct).values_list('pk', flat=True)[:chunk_size])
+                if not ids:
+                    break
+                ObjectPermission.objects.bulk_delete(
+                    ObjectPermission.objects.filter(pk__in=ids))
+                deleted += len(ids)
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+            self.stdout.write("%s: %d deleted\n" % (label, deleted))
+            total += deleted
+        self.stdout.write("Total: %d\n" % total)
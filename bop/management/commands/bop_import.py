@@ -0,0 +1,149 @@
+import csv
+import sys
+import time
+from optparse import make_option
+
+try:
+    import json
+except ImportError: # Python < 2.6
+    from django.utils import simplejson as json
+
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+
+from bop.management.commands.bop_export import FIELDS, FORMATS
+from bop.models import ObjectPermission
+
+
+class Resolver(object):
+    """ Turns natural keys into primary keys (remembering the answers) """
+
+    def __init__(self):
+        self.cache = {}
+
+    def _get(self, kind, key, lookup):
+        if (kind, key) not in self.cache:
+            try:
+                self.cache[(kind, key)] = lookup()
+            except (ObjectDoesNotExist, ValueError):
+                self.cache[(kind, key)] = None
+        return self.cache[(kind, key)]
+
+    def permission(self, key, content_type_id):
+        """ Returns the pk of permission 'app_label.codename'; if several
+        models in the app have that codename the one of the object's
+        content type is used
+        """
+        def lookup():
+            app_label, codename = key.split('.')
+            pks = list(Permission.objects.filter(
+                    content_type__app_label=app_label,
+                    codename=codename).values_list('pk', flat=True)[:2])
+            if len(pks) > 1:
+                pks = list(Permission.objects.filter(
+                        content_type=content_type_id,
+                        codename=codename).values_list('pk', flat=True))
+            if len(pks) != 1:
+                raise ValueError(key)
+            return pks[0]
+        return self._get('permission', (key, content_type_id), lookup)
+
+    def content_type(self, key):
+        def lookup():
+            app_label, model = key.split('.')
+            return ContentType.objects.get(app_label=app_label, model=model).pk
+        return self._get('content_type', key, lookup)
+
+    def user(self, key):
+        return self._get('user', key,
+                         lambda: User.objects.get(username=key).pk)
+
+    def group(self, key):
+        return self._get('group', key,
+                         lambda: Group.objects.get(name=key).pk)
+
+    def __call__(self, row):
+        """ Returns an (unsaved) ObjectPermission for row or None """
+        try:
+            user_id = row.get('user') and self.user(row['user'])
+            group_id = row.get('group') and self.group(row['group'])
+            content_type_id = self.content_type(row['content_type'])
+            permission_id = self.permission(row['permission'], content_type_id)
+            object_id = int(row['object_id'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            # A malformed row, or one for an object without an integer pk
+            return None
+        op = ObjectPermission(
+            permission_id=permission_id,
+            content_type_id=content_type_id,
+            object_id=object_id,
+            user_id=user_id or None,
+            group_id=group_id or None)
+        if None in (op.permission_id, op.content_type_id) or \
+                bool(op.user_id) == bool(op.group_id):
+            return None
+        return op
+
+
+def read_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(stream):
+    reader = csv.reader(stream)
+    header = reader.next()
+    if tuple(header) != FIELDS:
+        raise CommandError("Expected the columns %s" % ','.join(FIELDS))
+    for row in reader:
+        yield dict(zip(FIELDS, [v.decode('utf-8') for v in row]))
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+                    help='Input format: jsonl (default) or csv'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of rows to insert at once'),
+        )
+    help = ("Imports ObjectPermissions exported with bop_export. "
+            "Permissions that already exist are skipped.")
+    args = '[file ...]'
+
+    def handle(self, *args, **options):
+        if options['format'] not in FORMATS:
+            raise CommandError("Unknown format '%s'" % options['format'])
+        read = options['format'] == 'csv' and read_csv or read_jsonl
+        batch_size = options['batch_size']
+        resolve = Resolver()
+        start = time.time()
+        self.read = self.inserted = self.skipped = 0
+        for name in args or ['-']:
+            stream = name == '-' and sys.stdin or open(name, 'rb')
+            batch = []
+            for row in read(stream):
+                self.read += 1
+                op = resolve(row)
+                if op is None:
+                    self.skipped += 1
+                    continue
+                batch.append(op)
+                if len(batch) >= batch_size:
+                    self.insert(batch)
+                    batch = []
+            self.insert(batch)
+            if stream is not sys.stdin:
+                stream.close()
+        elapsed = max(time.time() - start, 0.001)
+        self.stderr.write(
+            "Read %d rows, inserted %d, skipped %d unresolvable "
+            "in %.1fs (%d rows/s)\n" % (self.read, self.inserted, self.skipped,
+                                        elapsed, self.read / elapsed))
+
+    def insert(self, batch):
+        self.inserted += len(ObjectPermission.objects.bulk_insert(batch))
@@ -0,0 +1,257 @@
+import multiprocessing
+import random
+import threading
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+try:
+    from django.db.transaction import rollback_unless_managed
+except ImportError: # Django >= 1.6 runs in autocommit mode
+    def rollback_unless_managed(using=None):
+        pass
+
+from bop.api import grant, revoke
+
+
+OPERATIONS = ('check', 'objects', 'grant', 'revoke')
+
+DEFAULT_RATIOS = 'check=80,objects=10,grant=5,revoke=5'
+
+
+def parse_ratios(value):
+    """ Turns 'check=80,grant=20' into {'check': 80, 'grant': 20} """
+    ratios = {}
+    for part in value.split(','):
+        try:
+            name, weight = part.split('=')
+            weight = int(weight)
+        except ValueError:
+            raise CommandError("Invalid ratio '%s'" % part)
+        if name not in OPERATIONS:
+            raise CommandError("Unknown operation '%s' (expected one of %s)"
+                               % (name, ', '.join(OPERATIONS)))
+        if weight > 0:
+            ratios[name] = weight
+    if not ratios:
+        raise CommandError("No operations to run")
+    return ratios
+
+
+def percentile(values, p):
+    """ Returns the p-th percentile of the sorted list `values` """
+    if not values:
+        return 0.0
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+class Worker(object):
+    """ Runs a random mix of operations as fast as it can and records
+    the latency (in ms) of each and the errors
+    """
+    def __init__(self, model, perm, user_ids, object_ids, ratios, seed=None):
+        self.model = model
+        self.perm = perm
+        self.users = list(User.objects.filter(pk__in=user_ids))
+        self.instances = [model(pk=pk) for pk in object_ids]
+        self.choices = []
+        for name, weight in ratios.items():
+            self.choices.extend([name] * weight)
+        self.random = random.Random(seed)
+        # operation -> [latencies, number of errors]
+        self.stats = dict((name, [[], 0]) for name in ratios)
+        # error message -> count
+        self.errors = {}
+
+    def check(self, user, obj):
+        user.has_perm(self.perm, obj)
+
+    def objects(self, user, obj):
+        list(self.model._default_manager.get_user_objects(
+                user, self.perm).values_list('pk', flat=True)[:100])
+
+    def grant(self, user, obj):
+        grant(user, None, self.perm, obj)
+
+    def revoke(self, user, obj):
+        revoke(user, None, self.perm, obj)
+
+    def run(self, operations=None, until=None):
+        done = 0
+        while (operations is None or done < operations) and \
+                (until is None or time.time() < until):
+            name = self.random.choice(self.choices)
+            user = self.random.choice(self.users)
+            obj = self.random.choice(self.instances)
+            start = time.time()
+            try:
+                getattr(self, name)(user, obj)
+            except Exception as e:
+                rollback_unless_managed()
+                self.stats[name][1] += 1
+                message = "%s: %s" % (e.__class__.__name__, str(e)[:100])
+                self.errors[message] = self.errors.get(message, 0) + 1
+            else:
+                self.stats[name][0].append((time.time() - start) * 1000)
+            done += 1
+        return self.stats, self.errors
+
+
+def merge(results):
+    """ Merges the (stats, errors) of several workers """
+    stats, errors = {}, {}
+    for worker_stats, worker_errors in results:
+        for name, (latencies, count) in worker_stats.items():
+            merged = stats.setdefault(name, [[], 0])
+            merged[0].extend(latencies)
+            merged[1] += count
+        for message, count in worker_errors.items():
+            errors[message] = errors.get(message, 0) + count
+    return stats, errors
+
+
+def run_threads(config, threads, seed):
+    """ Runs `threads` Workers and returns their merged results """
+    if threads == 1:
+        return merge([Worker(seed=seed, **config['worker']).run(
+                    config['operations'], config['until'])])
+    results = []
+    def target(i):
+        try:
+            worker = Worker(seed=seed and seed + i, **config['worker'])
+            results.append(worker.run(config['operations'], config['until']))
+        finally:
+            # Each thread has its own connection
+            for connection in connections.all():
+                connection.close()
+    workers = [threading.Thread(target=target, args=(i,))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return merge(results)
+
+
+def _run_process(queue, config, threads, seed):
+    queue.put(run_threads(config, threads, seed))
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', dest='threads', default=1,
+                    help='Number of threads per process'),
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of processes'),
+        make_option('--duration', type='float', dest='duration', default=10,
+                    help='Seconds to run'),
+        make_option('--operations', type='int', dest='operations',
+                    default=None,
+                    help='Operations per thread (instead of --duration)'),
+        make_option('--ratios', dest='ratios', default=DEFAULT_RATIOS,
+                    help='The mix of operations (default: %s)' % DEFAULT_RATIOS),
+        make_option('--permission', dest='permission', default=None,
+                    help='app_label.codename (default: the change '
+                    'permission of the model)'),
+        make_option('--users', type='int', dest='users', default=100,
+                    help='Number of (active, non-superuser) users to use'),
+        make_option('--objects', type='int', dest='objects', default=1000,
+                    help='Number of objects to use'),
+        make_option('--seed', type='int', dest='seed', default=None,
+                    help='Seed for the random choices'),
+        )
+    help = ("Runs a concurrent mix of has_perm (check), get_user_objects "
+            "(objects), grant and revoke against the database and reports "
+            "throughput, latencies and errors. Grants and revokes change "
+            "the database: do not run this against production.")
+    args = 'app_label.model'
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Expected one app_label.model")
+        try:
+            app_label, model_name = args[0].split('.')
+            model = ContentType.objects.get(
+                app_label=app_label, model=model_name).model_class()
+        except (ValueError, ContentType.DoesNotExist):
+            model = None
+        if model is None:
+            raise CommandError("Unknown model '%s'" % args[0])
+        ratios = parse_ratios(options['ratios'])
+        if 'objects' in ratios and \
+                not hasattr(model._default_manager, 'get_user_objects'):
+            raise CommandError("The default manager of %s is not a "
+                               "UserObjectManager; leave out 'objects'"
+                               % args[0])
+        perm = options['permission'] or '%s.%s' % (
+            model._meta.app_label, model._meta.get_change_permission())
+        user_ids = list(User.objects.filter(
+                is_active=True, is_superuser=False).order_by('pk').values_list(
+                'pk', flat=True)[:options['users']])
+        object_ids = list(model._default_manager.order_by('pk').values_list(
+                'pk', flat=True)[:options['objects']])
+        if not user_ids or not object_ids:
+            raise CommandError("Need at least one user and one object")
+        threads, processes = options['threads'], options['processes']
+        if threads < 1 or processes < 1:
+            raise CommandError("Need at least one thread and one process")
+        config = {
+            'worker': dict(model=model, perm=perm, user_ids=user_ids,
+                           object_ids=object_ids, ratios=ratios),
+            'operations': options['operations'],
+            'until': None,
+            }
+        seed = options['seed']
+        start = time.time()
+        if options['operations'] is None:
+            config['until'] = start + options['duration']
+        if processes == 1:
+            stats, errors = run_threads(config, threads, seed)
+        else:
+            # The children must not share the connections of the parent
+            for connection in connections.all():
+                connection.close()
+            queue = multiprocessing.Queue()
+            children = [multiprocessing.Process(
+                    target=_run_process, args=(
+                        queue, config, threads, seed and seed + i * threads))
+                        for i in range(processes)]
+            for child in children:
+                child.start()
+            results = [queue.get() for child in children]
+            for child in children:
+                child.join()
+            stats, errors = merge(results)
+        elapsed = max(time.time() - start, 0.001)
+        self.report(stats, errors, elapsed, threads, processes)
+
+    def report(self, stats, errors, elapsed, threads, processes):
+        write = self.stdout.write
+        write("%-10s %8s %8s %8s %8s %8s\n" % (
+                'operation', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+        total = [[], 0]
+        for name in OPERATIONS:
+            if name not in stats:
+                continue
+            latencies, failed = stats[name]
+            total[0].extend(latencies)
+            total[1] += failed
+            self.report_line(name, latencies, failed)
+        self.report_line('total', *total)
+        count = len(total[0]) + total[1]
+        write("%d operations in %.1fs: %.1f/s (%d threads x %d processes), "
+              "error rate %.2f%%\n" % (
+                count, elapsed, count / elapsed, threads, processes,
+                count and 100.0 * total[1] / count))
+        for message, count in sorted(errors.items(), key=lambda e: -e[1]):
+            write("%6d x %s\n" % (count, message))
+
+    def report_line(self, name, latencies, failed):
+        latencies = sorted(latencies)
+        self.stdout.write("%-10s %8d %8d %8.1f %8.1f %8.1f\n" % (
+                name, len(latencies) + failed, failed,
+                percentile(latencies, 50), percentile(latencies, 95),
+                percentile(latencies, 99)))
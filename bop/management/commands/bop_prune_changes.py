@@ -0,0 +1,52 @@
+import time
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from bop.changelog import version_range
+from bop.models import ObjectPermissionChange
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=30,
+                    help='Keep the changes of the last DAYS days'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only report the number of changes to delete'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=10000,
+                    help='Number of versions to delete at once'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+                    help='Seconds to sleep between chunks'),
+        )
+    help = ("Deletes the changes in the ObjectPermission change log that "
+            "are older than --days (the latest change is always kept so "
+            "the version does not go back)")
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['chunk_size'] < 1:
+            raise CommandError("--days can not be negative and --chunk-size "
+                               "must be at least 1")
+        cutoff = datetime.now() - timedelta(days=options['days'])
+        last = ObjectPermissionChange.objects.filter(
+            created__lt=cutoff).aggregate(last=Max('pk'))['last'] or 0
+        oldest, latest = version_range()
+        last = min(last, latest - 1)
+        old = ObjectPermissionChange.objects.filter(pk__lte=last)
+        if options['dry_run']:
+            self.stdout.write("%d changes to delete\n" % old.count())
+            return
+        deleted = 0
+        start = oldest - 1
+        while start < last:
+            chunk = old.filter(pk__gt=start,
+                               pk__lte=start + options['chunk_size'])
+            deleted += chunk.count()
+            chunk.delete()
+            start += options['chunk_size']
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write("%d changes deleted\n" % deleted)
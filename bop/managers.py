@@ -1,9 +1,88 @@
+from __future__ import with_statement
+
+import base64
+import operator
+from collections import namedtuple
+from contextlib import contextmanager
+
 from django.conf import settings
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.db.models import Q
+from django.db.models.query import QuerySet
+try:
+    from django.db.transaction import atomic
+except ImportError: # Django < 1.6
+    @contextmanager
+    def atomic(using=None):
+        """ commit_on_success as a context manager (which it only is
+        from Django 1.3 on)
+
+        Inside a managed transaction (an outer atomic, the transaction
+        middleware) it is a savepoint: the commit is left to the owner
+        of the transaction.
+        """
+        if transaction.is_managed(using=using):
+            sid = transaction.savepoint(using=using)
+            try:
+                yield
+            except:
+                transaction.savepoint_rollback(sid, using=using)
+                raise
+            transaction.savepoint_commit(sid, using=using)
+            return
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+        try:
+            try:
+                yield
+            except:
+                if transaction.is_dirty(using=using):
+                    transaction.rollback(using=using)
+                raise
+            if transaction.is_dirty(using=using):
+                try:
+                    transaction.commit(using=using)
+                except:
+                    transaction.rollback(using=using)
+                    raise
+        finally:
+            transaction.leave_transaction_management(using=using)
+
+from bop.diagnostics import evaluate
+from bop.signals import deferred, muted, send_changed
+
+
+# The columns that make an ObjectPermission unique
+KEY_FIELDS = ('content_type', 'object_id', 'permission', 'user', 'group')
+
+PermissionKey = namedtuple(
+    'PermissionKey', 'content_type_id object_id permission_id user_id group_id')
+
+
+def permission_key(op):
+    """ Returns the PermissionKey for ObjectPermission `op` """
+    return PermissionKey(op.content_type_id, op.object_id,
+                         op.permission_id, op.user_id, op.group_id)
+
+
+def chunked_iterator(queryset, chunk_size=1000):
+    """ Iterates over `queryset` in primary key order, fetching
+    chunk_size objects at a time (so memory use stays flat)
+    """
+    last = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        for obj in chunk:
+            yield obj
+        last = chunk[-1].pk
 
 
 class ObjectPermissionManager(models.Manager):
@@ -16,24 +95,298 @@ class ObjectPermissionManager(models.Manager):
                 ' settings.AUTHENTICATION_BACKENDS')
         super(ObjectPermissionManager, self).__init__(*args, **kwargs)
 
+    def with_objects(self):
+        """ returns all ObjectPermissions with their user, group and
+        permission (select_related) and the objects they are about
+        (one query per content type)
+        """
+        return self.get_query_set()._clone(klass=ObjectsQuerySet).select_related(
+            'user', 'group', 'permission__content_type')
+
     def get_for_model(self, model):
         """ returns all ObjectPermissions for the given model """
         ct = ContentType.objects.get_for_model(model)
         return self.filter(content_type=ct)
 
+    def get_for_app(self, app_label):
+        """ returns all ObjectPermissions for the models in app_label """
+        return self.filter(content_type__app_label=app_label)
+
     def get_for_user(self, user):
         """ returns all ObjectPermissions for the given user """
+        from bop.caches import get_user_group_ids
         if user.is_anonymous():
             return self.none()
-        return self.filter(Q(group__in=user.groups.all()) |
+        return self.filter(Q(group__in=get_user_group_ids(user)) |
                            Q(user=user))
 
     def get_for_model_and_user(self, model, user):
         """ returns all ObjectPermissions for the given model AND user """
+        from bop.caches import get_user_group_ids
         if user.is_anonymous():
             return self.none()
         return self.get_for_model(model).filter(
-            Q(group__in=user.groups.all()) | Q(user=user))
+            Q(group__in=get_user_group_ids(user)) | Q(user=user))
+
+    def get_users_with_perm(self, obj, perm):
+        """ returns the (active) users that have `perm` on `obj`, directly
+        or via one of their groups
+        """
+        return self.get_users_with_perm_bulk([obj], perm)
+
+    def get_users_with_perm_bulk(self, objects, perm):
+        """ returns the (active) users that have `perm` on any of
+        `objects`, directly or via one of their groups
+
+        The users are fetched with a single query. For very large
+        results use chunked_iterator:
+
+        for user in chunked_iterator(ObjectPermission.objects.get_users_with_perm(obj, perm)):
+            ...
+        """
+        from bop.groups import get_member_groups
+        from bop.models import get_permission_model
+        app_label, codename = perm.split('.')
+        # (permission model, content_type.pk) -> object ids
+        object_ids = {}
+        for obj in objects:
+            ct = ContentType.objects.get_for_model(obj)
+            object_ids.setdefault((get_permission_model(obj), ct.pk),
+                                  set()).add(obj.pk)
+        if not object_ids:
+            return User.objects.none()
+        by_model = {}
+        for (model, ct_id), ids in object_ids.items():
+            by_model.setdefault(model, []).append(
+                model.objects.filter_objects(ct_id, ids))
+        users = []
+        for model, querysets in by_model.items():
+            ops = reduce(operator.or_, querysets).filter(
+                permission__content_type__app_label=app_label,
+                permission__codename=codename)
+            members = User.groups.through.objects.filter(
+                group__in=get_member_groups(
+                    ops.filter(group__isnull=False).values('group')))
+            users.append(Q(pk__in=ops.filter(user__isnull=False).values('user')))
+            users.append(Q(pk__in=members.values('user')))
+        return User.objects.filter(reduce(operator.or_, users), is_active=True)
+
+    def filter_objects(self, content_type_id, object_ids):
+        """ returns the ObjectPermissions on the objects (of
+        content_type_id) with the given ids
+        """
+        return self.filter(content_type=content_type_id,
+                           object_id__in=object_ids)
+
+    def keys(self, queryset):
+        """ yields (pk, PermissionKey) for the ObjectPermissions in
+        `queryset`
+        """
+        for row in queryset.values_list('pk', *KEY_FIELDS):
+            yield row[0], PermissionKey(*row[1:])
+
+    def existing_keys(self, keys, chunk_size=500):
+        """ returns the subset of PermissionKeys in `keys` that exist """
+        object_ids = {}
+        for key in keys:
+            object_ids.setdefault(key.content_type_id, set()).add(key.object_id)
+        existing = set()
+        for ct_id, ids in object_ids.items():
+            ids = list(ids)
+            for i in range(0, len(ids), chunk_size):
+                existing.update(key for pk, key in self.keys(
+                        self.filter_objects(ct_id, ids[i:i+chunk_size])))
+        return existing.intersection(keys)
+
+    def bulk_insert(self, objs, batch_size=500):
+        """ Inserts the (unsaved) ObjectPermissions in `objs` that do
+        not exist yet and returns the ones that were inserted
+
+        Duplicates (within `objs` and with the database) are skipped so
+        calling this more than once with the same objs is harmless. Rows
+        that another process inserts concurrently are skipped too (see
+        _insert_batch).
+        """
+        new, seen = [], set()
+        for obj in objs:
+            key = permission_key(obj)
+            if key not in seen:
+                seen.add(key)
+                new.append((key, obj))
+        if not new:
+            return []
+        existing = self.existing_keys(seen)
+        new = [(key, obj) for key, obj in new if key not in existing]
+        objs = [obj for key, obj in new]
+        inserted = []
+        with muted():
+            for i in range(0, len(objs), batch_size):
+                inserted.extend(self._insert_batch(objs[i:i+batch_size]))
+        send_changed(added=[permission_key(obj) for obj in inserted])
+        return inserted
+
+    def delete_keys(self, keys, chunk_size=500):
+        """ Deletes the ObjectPermissions with the given PermissionKeys
+        and returns the keys of the rows that were deleted
+        """
+        keys = set(keys)
+        object_ids = {}
+        for key in keys:
+            object_ids.setdefault(key.content_type_id, set()).add(key.object_id)
+        pks = []
+        for ct_id, ids in object_ids.items():
+            ids = list(ids)
+            for i in range(0, len(ids), chunk_size):
+                pks.extend(pk for pk, key in self.keys(self.filter_objects(
+                            ct_id, ids[i:i+chunk_size])) if key in keys)
+        removed = []
+        with deferred():
+            for i in range(0, len(pks), chunk_size):
+                removed.extend(self.bulk_delete(
+                        self.filter(pk__in=pks[i:i+chunk_size])))
+        return removed
+
+    def bulk_delete(self, queryset, chunk_size=500):
+        """ Deletes the ObjectPermissions in `queryset` and returns the
+        PermissionKeys of the deleted rows
+        """
+        rows = list(self.keys(queryset))
+        with muted():
+            for i in range(0, len(rows), chunk_size):
+                self.filter(
+                    pk__in=[pk for pk, key in rows[i:i+chunk_size]]).delete()
+        removed = [key for pk, key in rows]
+        send_changed(removed=removed)
+        return removed
+
+    def _insert_batch(self, objs):
+        """ Inserts `objs` and returns the ones that were inserted
+
+        When a concurrent insert of the same row makes the batch fail
+        (IntegrityError) the batch is rolled back to a savepoint and the
+        rows are inserted one by one, each in its own savepoint,
+        skipping the ones that now exist. It all runs in a transaction:
+        outside one, Django < 1.6 commits after every save, which
+        releases the savepoints.
+        """
+        with atomic(using=self.db):
+            if hasattr(self, 'bulk_create') and len(objs) > 1:
+                sid = transaction.savepoint(using=self.db)
+                try:
+                    self.bulk_create(objs)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid, using=self.db)
+                else:
+                    transaction.savepoint_commit(sid, using=self.db)
+                    return objs
+            inserted = []
+            for obj in objs:
+                sid = transaction.savepoint(using=self.db)
+                try:
+                    obj.save(force_insert=True, using=self.db)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid, using=self.db)
+                else:
+                    transaction.savepoint_commit(sid, using=self.db)
+                    inserted.append(obj)
+            return inserted
+
+
+class TypedObjectPermissionManager(ObjectPermissionManager):
+    """ The manager of TypedObjectPermissions (see bop.models)
+
+    All rows are for the objects of one model, so there is no
+    content_type to filter on.
+    """
+    def get_for_model(self, model):
+        return self.all()
+
+    def get_for_app(self, app_label):
+        if self.model.get_content_type().app_label == app_label:
+            return self.all()
+        return self.none()
+
+    def filter_objects(self, content_type_id, object_ids):
+        return self.filter(object__in=object_ids)
+
+    def keys(self, queryset):
+        ct_id = self.model.get_content_type().pk
+        for pk, object_id, permission_id, user_id, group_id in \
+                queryset.values_list('pk', 'object', 'permission', 'user', 'group'):
+            yield pk, PermissionKey(ct_id, object_id, permission_id,
+                                    user_id, group_id)
+
+
+class ObjectsQuerySet(QuerySet):
+    """ A QuerySet of ObjectPermissions that fetches the objects of the
+    ObjectPermissions it returns in bulk (with in_bulk per content type)
+    """
+    def iterator(self):
+        ops = list(super(ObjectsQuerySet, self).iterator())
+        object_ids = {}
+        for op in ops:
+            object_ids.setdefault(op.content_type_id, set()).add(op.object_id)
+        objects = {}
+        for ct_id, ids in object_ids.items():
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            objects[ct_id] = {}
+            if model is None:
+                continue
+            ids = list(ids)
+            for i in range(0, len(ids), 500):
+                objects[ct_id].update(
+                    model._default_manager.in_bulk(ids[i:i+500]))
+        cache_attr = self.model.object.cache_attr
+        for op in ops:
+            setattr(op, cache_attr, objects[op.content_type_id].get(op.object_id))
+            yield op
+
+
+class UserPermsQuerySet(QuerySet):
+    """ A QuerySet that sets `user_perms`, the set of codenames of the
+    permissions a user has, on each object it returns
+
+    The permissions of all objects are fetched with one extra query
+    (per 500 objects).
+    """
+    _bop_user = None
+    _bop_model_perms = ()
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_bop_user', self._bop_user)
+        kwargs.setdefault('_bop_model_perms', self._bop_model_perms)
+        return super(UserPermsQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def iterator(self):
+        objects = list(super(UserPermsQuerySet, self).iterator())
+        if self._bop_user is not None:
+            self._set_user_perms(objects)
+        for obj in objects:
+            yield obj
+
+    def _set_user_perms(self, objects):
+        from bop.api import get_model_perms, get_subject
+        from bop.caches import get_user_group_ids
+        from bop.models import get_permission_model
+        user = self._bop_user
+        perms = dict((obj.pk, set(self._bop_model_perms)) for obj in objects)
+        subject = objects and get_subject(user)
+        if user.is_active and user.is_superuser:
+            for obj_perms in perms.values():
+                obj_perms.update(get_model_perms(self.model))
+        elif subject:
+            ids = list(perms)
+            ct = ContentType.objects.get_for_model(self.model)
+            model = get_permission_model(self.model)
+            for i in range(0, len(ids), 500):
+                for object_id, codename in evaluate(model.objects.filter_objects(
+                        ct.pk, ids[i:i+500]).filter(
+                        Q(user=subject) | Q(group__in=get_user_group_ids(subject))
+                        ).values_list(model.object_field, 'permission__codename'),
+                                                    'UserObjectManager.with_user_perms'):
+                    perms[object_id].add(codename)
+        for obj in objects:
+            obj.user_perms = perms[obj.pk]
 
 
 class UserObjectManager(models.Manager):
@@ -56,19 +409,29 @@ class UserObjectManager(models.Manager):
         superclass to the existing custom manager.
         """
 
-        if user.is_superuser:
+        ops = self._user_object_permissions(user, permissions, check_model_perms)
+        if ops is None:
             return self.all()
+        return self._queryset_for(ops).filter(pk__in=ops.values_list(
+                ops.model.object_field, flat=True).distinct())
+
+    def _user_object_permissions(self, user, permissions, check_model_perms):
+        """ Returns the ObjectPermissions that give user access to
+        objects of this model or None if user can access all of them
+        """
+        if user.is_superuser:
+            return None
 
         # importing here to avoid circular imports
         from bop.api import resolve, perm2dict, has_model_perms
-        from bop.models import ObjectPermission
+        from bop.models import get_permission_model
         # A quick check first
         if check_model_perms and not permissions:
             # If there are no specific permissions and check_model_perms
             # is set *and* the user has *any* (model) perms
             # UserObjectManager will return the entire set
             if has_model_perms(user, self.model):
-                return self.all()
+                return None
 
         if permissions:
             permissions = resolve(permissions, Permission, perm2dict)
@@ -77,10 +440,77 @@ class UserObjectManager(models.Manager):
             for p in permissions:
                 if user.has_perm("%s.%s" % \
                                      (self.model._meta.app_label, p.codename)):
-                    return self.all()
+                    return None
 
-        ops = ObjectPermission.objects.get_for_model_and_user(self.model, user)
+        ops = get_permission_model(self.model).objects.get_for_model_and_user(
+            self.model, user)
 
         if permissions:
             ops = ops.filter(permission__in=permissions)
-        return self.filter(pk__in=ops.values_list('object_id', flat=True).distinct())
+        return ops
+
+    def _queryset_for(self, ops):
+        # The ObjectPermissions may be read from another database (see
+        # bop.routers) and queries that use them have to run on the
+        # same one.
+        queryset = self.get_query_set()
+        if queryset.db != ops.db:
+            queryset = queryset.using(ops.db)
+        return queryset
+
+    def get_user_objects_page(self, user, cursor=None, limit=50,
+                              permissions=None, check_model_perms=False):
+        """ Returns a page of the objects get_user_objects returns and the
+        cursor for the next page (or None)
+
+        objects, cursor = MyModel.objects.get_user_objects_page(user)
+        more, cursor = MyModel.objects.get_user_objects_page(user, cursor)
+
+        Pages are ordered by primary key and walk the index on
+        ObjectPermission.object_id (keyset pagination) so every page
+        costs the same, however deep. The cursor is an opaque string.
+        """
+        after = 0
+        if cursor:
+            try:
+                after = int(base64.urlsafe_b64decode(str(cursor)))
+            except (TypeError, ValueError):
+                raise ValueError("Invalid cursor '%s'" % cursor)
+        ops = self._user_object_permissions(user, permissions, check_model_perms)
+        if ops is None:
+            objects = list(self.filter(pk__gt=after).order_by('pk')[:limit])
+            ids = [obj.pk for obj in objects]
+        else:
+            field = ops.model.object_field
+            ids = evaluate(ops.filter(**{field + '__gt': after}).order_by(
+                    field).values_list(field, flat=True).distinct()[:limit],
+                           'UserObjectManager.get_user_objects_page')
+            objects = self._queryset_for(ops).in_bulk(ids)
+            objects = [objects[pk] for pk in ids if pk in objects]
+        if len(ids) < limit:
+            return objects, None
+        return objects, base64.urlsafe_b64encode(str(ids[-1]))
+
+    def with_user_perms(self, user, permissions=None, check_model_perms=False):
+        """ Like get_user_objects but every object gets a `user_perms`
+        attribute: the set of codenames of the permissions user has on
+        the object
+
+        for obj in MyModel.objects.with_user_perms(request.user):
+            if 'change_mymodel' in obj.user_perms:
+                ...
+
+        With check_model_perms the user's model permissions are
+        included as well.
+        """
+        model_perms = ()
+        if check_model_perms:
+            from bop.api import get_model_perms
+            codenames = get_model_perms(self.model)
+            model_perms = [codename for app_label, codename in
+                           [perm.split('.') for perm in user.get_all_permissions()]
+                           if app_label == self.model._meta.app_label and
+                           codename in codenames]
+        queryset = self.get_user_objects(user, permissions, check_model_perms)
+        return queryset._clone(klass=UserPermsQuerySet, _bop_user=user,
+                               _bop_model_perms=tuple(model_perms))
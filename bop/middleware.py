@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+
+from bop.routers import pin_primary, unpin_primary, pinned_until
+
+
+class PinPrimaryMiddleware(object):
+    """ Keeps reading ObjectPermissions from the primary database, in
+    later requests of the same client, after permissions have been
+    granted or revoked
+
+    Uses a cookie (named by BOP_PIN_COOKIE) that holds the time until
+    which reads are pinned.
+    """
+    def _cookie_name(self):
+        return getattr(settings, 'BOP_PIN_COOKIE', 'bop_pin')
+
+    def process_request(self, request):
+        unpin_primary()
+        try:
+            until = float(request.COOKIES.get(self._cookie_name(), 0))
+        except ValueError:
+            until = 0
+        if until > time.time():
+            pin_primary(until)
+        request._bop_pinned_until = pinned_until()
+
+    def process_response(self, request, response):
+        until = pinned_until()
+        if until and until != getattr(request, '_bop_pinned_until', 0):
+            response.set_cookie(self._cookie_name(), str(until),
+                                max_age=int(until - time.time()) + 1)
+        return response
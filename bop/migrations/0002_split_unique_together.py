@@ -0,0 +1,92 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # The old constraint included both user and group, one of which
+        # is always NULL, so most databases did not enforce it. Rows
+        # that are duplicates under the new constraints have to go first.
+        duplicates = orm['bop.ObjectPermission'].objects.values(
+            'content_type', 'object_id', 'permission', 'user', 'group'
+            ).annotate(n=models.Count('id')).filter(n__gt=1).order_by()
+        if duplicates.exists():
+            raise RuntimeError(
+                "There are duplicate ObjectPermissions. Remove them with "
+                "'./manage.py bop_dedupe' and migrate again.")
+
+        # Removing unique constraint on 'ObjectPermission', fields ['content_type', 'object_id', 'permission', 'group', 'user']
+        db.delete_unique('bop_objectpermission', ['content_type_id', 'object_id', 'permission_id', 'group_id', 'user_id'])
+
+        # Adding unique constraint on 'ObjectPermission', fields ['content_type', 'object_id', 'permission', 'user']
+        db.create_unique('bop_objectpermission', ['content_type_id', 'object_id', 'permission_id', 'user_id'])
+
+        # Adding unique constraint on 'ObjectPermission', fields ['content_type', 'object_id', 'permission', 'group']
+        db.create_unique('bop_objectpermission', ['content_type_id', 'object_id', 'permission_id', 'group_id'])
+
+
+    def backwards(self, orm):
+
+        # Removing unique constraint on 'ObjectPermission', fields ['content_type', 'object_id', 'permission', 'group']
+        db.delete_unique('bop_objectpermission', ['content_type_id', 'object_id', 'permission_id', 'group_id'])
+
+        # Removing unique constraint on 'ObjectPermission', fields ['content_type', 'object_id', 'permission', 'user']
+        db.delete_unique('bop_objectpermission', ['content_type_id', 'object_id', 'permission_id', 'user_id'])
+
+        # Adding unique constraint on 'ObjectPermission', fields ['content_type', 'object_id', 'permission', 'group', 'user']
+        db.create_unique('bop_objectpermission', ['content_type_id', 'object_id', 'permission_id', 'group_id', 'user_id'])
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'bop.objectpermission': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'permission', 'user'), ('content_type', 'object_id', 'permission', 'group'))", 'object_name': 'ObjectPermission'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'group': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.Group']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'permission': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.Permission']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']", 'null': 'True', 'blank': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['bop']
@@ -0,0 +1,111 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Adding model 'GroupNesting'
+        db.create_table('bop_groupnesting', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('parent', self.gf('django.db.models.fields.related.ForeignKey')(related_name='bop_children', to=orm['auth.Group'])),
+            ('child', self.gf('django.db.models.fields.related.ForeignKey')(related_name='bop_parents', to=orm['auth.Group'])),
+        ))
+        db.send_create_signal('bop', ['GroupNesting'])
+
+        # Adding unique constraint on 'GroupNesting', fields ['parent', 'child']
+        db.create_unique('bop_groupnesting', ['parent_id', 'child_id'])
+
+        # Adding model 'GroupClosure'
+        db.create_table('bop_groupclosure', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('ancestor', self.gf('django.db.models.fields.related.ForeignKey')(related_name='bop_descendants', to=orm['auth.Group'])),
+            ('descendant', self.gf('django.db.models.fields.related.ForeignKey')(related_name='bop_ancestors', to=orm['auth.Group'])),
+            ('depth', self.gf('django.db.models.fields.PositiveIntegerField')()),
+        ))
+        db.send_create_signal('bop', ['GroupClosure'])
+
+        # Adding unique constraint on 'GroupClosure', fields ['descendant', 'ancestor']
+        db.create_unique('bop_groupclosure', ['descendant_id', 'ancestor_id'])
+
+
+    def backwards(self, orm):
+
+        # Removing unique constraint on 'GroupClosure', fields ['descendant', 'ancestor']
+        db.delete_unique('bop_groupclosure', ['descendant_id', 'ancestor_id'])
+
+        # Removing unique constraint on 'GroupNesting', fields ['parent', 'child']
+        db.delete_unique('bop_groupnesting', ['parent_id', 'child_id'])
+
+        # Deleting model 'GroupClosure'
+        db.delete_table('bop_groupclosure')
+
+        # Deleting model 'GroupNesting'
+        db.delete_table('bop_groupnesting')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'bop.objectpermission': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'permission', 'user'), ('content_type', 'object_id', 'permission', 'group'))", 'object_name': 'ObjectPermission'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'group': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.Group']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'permission': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.Permission']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']", 'null': 'True', 'blank': 'True'})
+        },
+        'bop.groupclosure': {
+            'Meta': {'unique_together': "(('descendant', 'ancestor'),)", 'object_name': 'GroupClosure'},
+            'ancestor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'bop_descendants'", 'to': "orm['auth.Group']"}),
+            'depth': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'descendant': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'bop_ancestors'", 'to': "orm['auth.Group']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'bop.groupnesting': {
+            'Meta': {'unique_together': "(('parent', 'child'),)", 'object_name': 'GroupNesting'},
+            'child': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'bop_parents'", 'to': "orm['auth.Group']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'bop_children'", 'to': "orm['auth.Group']"})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['bop']
@@ -1,24 +1,24 @@
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import signals
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 
-from bop.managers import ObjectPermissionManager
+from bop.managers import ObjectPermissionManager, \
+    TypedObjectPermissionManager, PermissionKey, permission_key
+from bop.signals import is_muted, send_changed
 
 
-class ObjectPermission(models.Model):
+class BaseObjectPermission(models.Model):
+    """ The fields ObjectPermission and TypedObjectPermissions share """
     user = models.ForeignKey(User, null=True, blank=True)
     group = models.ForeignKey(Group, null=True, blank=True)
     permission = models.ForeignKey(Permission)
-    content_type = models.ForeignKey(ContentType)
-    object_id = models.PositiveIntegerField(db_index=True)
-    object = generic.GenericForeignKey('content_type', 'object_id')
-
-    objects      = ObjectPermissionManager()
 
     class Meta:
-        unique_together = ('content_type', 'object_id', 'permission', 'group', 'user')
+        abstract = True
 
     def clean(self):
         if (self.user is None and self.group is None) or \
@@ -32,3 +32,238 @@ class ObjectPermission(models.Model):
         else:
             return "Group '%s' has '%s' permission on %s" % \
                 (self.group, self.permission.codename, repr(self.object))
+
+
+class ObjectPermission(BaseObjectPermission):
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField(db_index=True)
+    object = generic.GenericForeignKey('content_type', 'object_id')
+
+    objects      = ObjectPermissionManager()
+
+    # The lookup for the pk of the object
+    object_field = 'object_id'
+
+    class Meta:
+        # One of user and group is always NULL, and NULLs are never
+        # equal, so each needs a constraint of its own (this assumes
+        # the database ignores rows with NULLs in unique keys, which
+        # SQL Server and Oracle do not)
+        unique_together = (('content_type', 'object_id', 'permission', 'user'),
+                           ('content_type', 'object_id', 'permission', 'group'))
+
+    @classmethod
+    def from_key(cls, key):
+        """ Returns an (unsaved) ObjectPermission for PermissionKey `key` """
+        return cls(**key._asdict())
+
+
+class TypedObjectPermission(BaseObjectPermission):
+    """ Base class for a permission table of its own for one model
+
+    ObjectPermission stores the permissions of all models in one table
+    with a generic foreign key. A TypedObjectPermission has a real
+    foreign key, named `object`, to the objects of one model:
+
+    class ThingPermission(TypedObjectPermission):
+        object = models.ForeignKey(Thing)
+
+    From then on ObjectBackend, UserObjectManager, grant, revoke etc.
+    read and write the permissions on Things in that table (and not in
+    ObjectPermission). Deleting a Thing cascades to its permissions.
+    """
+    objects = TypedObjectPermissionManager()
+
+    object_field = 'object__pk'
+
+    class Meta:
+        abstract = True
+        unique_together = (('object', 'permission', 'user'),
+                           ('object', 'permission', 'group'))
+
+    @classmethod
+    def get_content_type(cls):
+        return ContentType.objects.get_for_model(
+            cls._meta.get_field('object').rel.to)
+
+    @property
+    def content_type_id(self):
+        return self.get_content_type().pk
+
+    @classmethod
+    def from_key(cls, key):
+        return cls(object_id=key.object_id, permission_id=key.permission_id,
+                   user_id=key.user_id, group_id=key.group_id)
+
+
+class GroupNesting(models.Model):
+    """ `child` is nested in `parent`: the members of child get the
+    ObjectPermissions of parent (with BOP_NESTED_GROUPS, see bop.groups)
+    """
+    parent = models.ForeignKey(Group, related_name='bop_children')
+    child = models.ForeignKey(Group, related_name='bop_parents')
+
+    class Meta:
+        unique_together = ('parent', 'child')
+
+    def __unicode__(self):
+        return "Group '%s' is nested in '%s'" % (self.child, self.parent)
+
+
+class GroupClosure(models.Model):
+    """ `descendant` is nested in `ancestor`, directly (depth 1) or via
+    other groups
+
+    Maintained by bop.groups from the GroupNestings; do not edit.
+    """
+    ancestor = models.ForeignKey(Group, related_name='bop_descendants')
+    descendant = models.ForeignKey(Group, related_name='bop_ancestors')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        # descendant first: the groups of a user are looked up by
+        # descendant
+        unique_together = ('descendant', 'ancestor')
+
+
+class ObjectPermissionChange(models.Model):
+    """ A grant (added) or revoke in the change log (with
+    BOP_CHANGE_LOG, see bop.changelog)
+
+    The pk is the version of the change. The subject and permission are
+    plain ids so the log outlives deleted users, groups and permissions.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    permission_id = models.IntegerField()
+    user_id = models.IntegerField(null=True, blank=True)
+    group_id = models.IntegerField(null=True, blank=True)
+    added = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    @property
+    def version(self):
+        return self.pk
+
+    @property
+    def key(self):
+        return PermissionKey(self.content_type_id, self.object_id,
+                             self.permission_id, self.user_id, self.group_id)
+
+    def __unicode__(self):
+        return "%s %s" % (self.added and 'Granted' or 'Revoked', self.key)
+
+
+_typed_models = []
+
+# model -> the model that stores its permissions
+_permission_models = {}
+
+
+def get_permission_model(model):
+    """ Returns the model that stores the ObjectPermissions of `model` (a
+    model or an instance): its TypedObjectPermission or ObjectPermission
+    """
+    if isinstance(model, models.Model):
+        model = model.__class__
+    try:
+        return _permission_models[model]
+    except KeyError:
+        pass
+    concrete = model
+    while concrete is not None and concrete._meta.proxy:
+        concrete = concrete._meta.proxy_for_model
+    permission_model = ObjectPermission
+    for typed in _typed_models:
+        if typed._meta.get_field('object').rel.to is concrete:
+            permission_model = typed
+    _permission_models[model] = permission_model
+    return permission_model
+
+
+def get_permission_models():
+    """ Returns ObjectPermission and all TypedObjectPermissions """
+    return [ObjectPermission] + _typed_models
+
+
+def _permission_pre_save(sender, instance, raw=False, **kwargs):
+    # Remember what an existing ObjectPermission looked like
+    if instance.pk and not raw and not is_muted():
+        try:
+            instance._bop_old_key = permission_key(
+                sender.objects.get(pk=instance.pk))
+        except sender.DoesNotExist:
+            pass
+
+
+def _permission_post_save(sender, instance, created, **kwargs):
+    if is_muted():
+        return
+    old = getattr(instance, '_bop_old_key', None)
+    instance._bop_old_key = None
+    key = permission_key(instance)
+    if old != key:
+        send_changed(added=[key], removed=old and [old] or [])
+
+
+def _permission_post_delete(sender, instance, **kwargs):
+    if not is_muted():
+        send_changed(removed=[permission_key(instance)])
+
+
+def _connect_permission_signals(model):
+    signals.pre_save.connect(_permission_pre_save, sender=model)
+    signals.post_save.connect(_permission_post_save, sender=model)
+    signals.post_delete.connect(_permission_post_delete, sender=model)
+
+
+def _register_typed_model(sender, **kwargs):
+    if issubclass(sender, TypedObjectPermission) and \
+            not sender._meta.abstract and not sender._meta.proxy:
+        _typed_models.append(sender)
+        _permission_models.clear()
+        _connect_permission_signals(sender)
+
+
+_connect_permission_signals(ObjectPermission)
+signals.class_prepared.connect(_register_typed_model,
+                               dispatch_uid='bop.models._register_typed_model')
+
+
+def remove_object_permissions(sender, instance, **kwargs):
+    """ post_delete handler that removes the ObjectPermissions of a
+    deleted object
+
+    ObjectPermission.object is a GenericForeignKey so deleting an
+    object does not cascade to its permissions. Connect this handler
+    to the models you want to keep clean::
+
+      from django.db.models.signals import post_delete
+      from bop.models import remove_object_permissions
+
+      post_delete.connect(remove_object_permissions, sender=MyModel)
+
+    or set BOP_DELETE_OBJECT_PERMISSIONS = True in settings.py to
+    connect it for all models.
+    """
+    if issubclass(sender, BaseObjectPermission) or \
+            sender in (GroupNesting, GroupClosure, ObjectPermissionChange) or \
+            not isinstance(instance.pk, (int, long)) or \
+            get_permission_model(sender) is not ObjectPermission:
+        # TypedObjectPermissions are deleted by the cascade
+        return
+    ct = ContentType.objects.get_for_model(instance)
+    ObjectPermission.objects.bulk_delete(ObjectPermission.objects.filter(
+        content_type=ct, object_id=instance.pk))
+
+
+if getattr(settings, 'BOP_DELETE_OBJECT_PERMISSIONS', False):
+    signals.post_delete.connect(
+        remove_object_permissions,
+        dispatch_uid='bop.models.remove_object_permissions')
+
+
+# Connects the receivers that keep bop's caches up to date
+import bop.caches
+import bop.changelog
+import bop.snapshot
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from django.conf import settings
+
+from bop.signals import permissions_changed
+
+
+_state = threading.local()
+
+
+def _pin_seconds():
+    return getattr(settings, 'BOP_PIN_SECONDS', 5)
+
+
+def pin_primary(until=None):
+    """ Reads ObjectPermissions from the primary database until `until`
+    (a timestamp, default: BOP_PIN_SECONDS from now) in this thread
+
+    The pin is per thread (so per request), not per user.
+    """
+    if until is None:
+        until = time.time() + _pin_seconds()
+    _state.pinned_until = max(until, getattr(_state, 'pinned_until', 0))
+
+
+def unpin_primary():
+    _state.pinned_until = 0
+
+
+def pinned_until():
+    """ Returns the timestamp until which reads are pinned (or 0) """
+    until = getattr(_state, 'pinned_until', 0)
+    if until <= time.time():
+        return 0
+    return until
+
+
+def _pin_after_change(sender, **kwargs):
+    if getattr(settings, 'BOP_READ_DATABASE', None):
+        pin_primary()
+
+
+permissions_changed.connect(_pin_after_change,
+                            dispatch_uid='bop.routers._pin_after_change')
+
+
+class ObjectPermissionRouter(object):
+    """ Sends reads of ObjectPermissions to a replica
+
+    In settings.py::
+
+      DATABASE_ROUTERS = ['bop.routers.ObjectPermissionRouter']
+      BOP_READ_DATABASE = 'replica'
+
+    After permissions have been granted or revoked reads stick to the
+    primary (for BOP_PIN_SECONDS seconds) so the changes are seen
+    immediately. Add bop.middleware.PinPrimaryMiddleware to make that
+    stick across requests.
+    """
+    def db_for_read(self, model, **hints):
+        from bop.models import ObjectPermission
+        if model is ObjectPermission and not pinned_until():
+            return getattr(settings, 'BOP_READ_DATABASE', None)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_syncdb(self, db, model):
+        return None
@@ -0,0 +1,126 @@
+import threading
+from contextlib import contextmanager
+
+from django.core.signals import request_finished
+from django.db import connections, router, transaction
+from django.dispatch import Signal
+
+
+# Sent after ObjectPermissions have been added and/or removed. Both
+# arguments are lists of bop.managers.PermissionKey. When the changes
+# were made inside a transaction that is still open (an outer atomic,
+# ATOMIC_REQUESTS, the transaction middleware) it is sent again after
+# that transaction commits, see _send.
+permissions_changed = Signal(providing_args=['added', 'removed'])
+
+# Like permissions_changed but sent right away, in the transaction
+# that made the changes; permissions_changed may be sent later (at the
+# end of a deferred block) or not at all (if the block fails).
+permissions_written = Signal(providing_args=['added', 'removed'])
+
+
+_state = threading.local()
+
+
+@contextmanager
+def muted():
+    """ Stops ObjectPermission.save/delete from sending permissions_changed
+
+    Used by code that changes many ObjectPermissions at once and sends a
+    single permissions_changed itself.
+    """
+    _state.muted = getattr(_state, 'muted', 0) + 1
+    try:
+        yield
+    finally:
+        _state.muted -= 1
+
+
+def is_muted():
+    return getattr(_state, 'muted', 0) > 0
+
+
+@contextmanager
+def deferred():
+    """ Collects the changes sent with send_changed and sends them as a
+    single permissions_changed at the end of the block
+
+    Nested blocks are part of the outermost block. Nothing is sent if
+    the block raises an exception (the changes were rolled back).
+    """
+    if getattr(_state, 'pending', None) is not None:
+        yield
+        return
+    _state.pending = pending = ([], [])
+    try:
+        yield
+    except:
+        _state.pending = None
+        raise
+    _state.pending = None
+    if pending[0] or pending[1]:
+        _send(pending[0], pending[1])
+
+
+def _sender():
+    from bop.models import ObjectPermission
+    return ObjectPermission
+
+
+def _in_transaction(using):
+    """ Is a transaction that bop did not start open on `using`? """
+    connection = connections[using]
+    if hasattr(connection, 'in_atomic_block'): # Django >= 1.6
+        return connection.in_atomic_block
+    return transaction.is_managed(using=using)
+
+
+def _send(added, removed):
+    """ Sends permissions_changed, and again once the transaction the
+    changes were made in commits
+
+    A cache rebuilt between the first send and the commit read the old
+    rows under the new version; the second send throws that away.
+    Without on_commit (Django < 1.9) the second send waits for the end
+    of the request or the next change made outside a transaction.
+    """
+    sender = _sender()
+    using = router.db_for_write(sender)
+    in_transaction = _in_transaction(using)
+    if not in_transaction:
+        _send_uncommitted()
+    permissions_changed.send(sender=sender, added=added, removed=removed)
+    if not in_transaction:
+        return
+    resend = lambda: permissions_changed.send(
+        sender=sender, added=added, removed=removed)
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(resend, using=using)
+    else:
+        _state.uncommitted = getattr(_state, 'uncommitted', []) + [resend]
+
+
+def _send_uncommitted(**kwargs):
+    resends, _state.uncommitted = getattr(_state, 'uncommitted', []), []
+    for resend in resends:
+        resend()
+
+
+def send_changed(added=(), removed=()):
+    """ Sends permissions_written and permissions_changed (if anything
+    changed)
+    """
+    added, removed = list(added), list(removed)
+    if not added and not removed:
+        return
+    permissions_written.send(sender=_sender(), added=added, removed=removed)
+    pending = getattr(_state, 'pending', None)
+    if pending is not None:
+        pending[0].extend(added)
+        pending[1].extend(removed)
+        return
+    _send(added, removed)
+
+
+request_finished.connect(_send_uncommitted,
+                         dispatch_uid='bop.signals._send_uncommitted')
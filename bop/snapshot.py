@@ -0,0 +1,234 @@
+""" In-process snapshots of all ObjectPermissions of hot content types
+
+With BOP_SNAPSHOT_CONTENT_TYPES (a list of app_label.model) every
+process keeps all ObjectPermissions of those content types in memory
+and ObjectBackend answers checks on their objects without queries.
+
+Every change to the permissions of a content type increments a
+counter in the (shared) cache and stores the ids of the objects that
+changed under the new count. At most every BOP_SNAPSHOT_INTERVAL
+seconds (default 5) a snapshot compares its count with the counter and
+reloads only the objects that changed since. If the cache lost any of
+that (the epoch changed or an entry is missing) the whole content type
+is reloaded.
+
+With BOP_CHANGE_LOG the snapshots read the objects that changed from
+the change log (see bop.changelog) instead, and only reload everything
+when the log was pruned past their version.
+"""
+from __future__ import with_statement
+
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+
+from bop.caches import bump_versions, get_version, _timeout
+from bop.changelog import changelog_enabled, recent_changes, version_range
+from bop.models import get_permission_model
+from bop.signals import permissions_changed
+
+
+def _counter_key(ct_id):
+    return 'bop:snapshot:%s' % ct_id
+
+
+def snapshot_enabled(content_type):
+    return "%s.%s" % (content_type.app_label, content_type.model) in \
+        getattr(settings, 'BOP_SNAPSHOT_CONTENT_TYPES', ())
+
+
+def _interval():
+    return getattr(settings, 'BOP_SNAPSHOT_INTERVAL', 5)
+
+
+def _get_counter(ct_id):
+    """ Returns the epoch and the count of the changes of content type
+    ct_id (starting a new epoch if the cache lost the counter)
+    """
+    key = _counter_key(ct_id)
+    counter = cache.get(key)
+    if counter is None:
+        if cache.add(key, 0, _timeout()):
+            bump_versions([key + ':epoch'])
+        counter = cache.get(key) or 0
+    return get_version(key + ':epoch'), counter
+
+
+class Snapshot(object):
+    """ All ObjectPermissions of one content type """
+
+    def __init__(self, content_type):
+        self.content_type = content_type
+        # (epoch, count) of the counter or ('log', version) of the
+        # change log the snapshot is up to date with
+        self.state = None
+        # The versions of the recent changes read from the change log
+        self.seen = set()
+        self.checked = 0
+        self.lock = threading.Lock()
+        # A list of 'app_label.codename' (the position is the bit in the
+        # bitsets), a dict that maps object_id to {user_id: bitset} and
+        # one that maps object_id to {group_id: bitset}
+        self.index = ([], {}, {})
+
+    def _load(self, perms, object_ids=None):
+        """ Returns the users and groups dicts for `object_ids` (or for all
+        objects), adding new permissions to `perms`
+        """
+        model = get_permission_model(self.content_type.model_class())
+        if object_ids is None:
+            ops = model.objects.get_for_model(self.content_type.model_class())
+        else:
+            ops = model.objects.filter_objects(self.content_type.pk, object_ids)
+        users, groups = {}, {}
+        for object_id, user_id, group_id, app_label, codename in \
+                ops.values_list(model.object_field, 'user', 'group',
+                                'permission__content_type__app_label',
+                                'permission__codename'):
+            label = "%s.%s" % (app_label, codename)
+            if label not in perms:
+                perms.append(label)
+            bit = 1 << perms.index(label)
+            if user_id:
+                subjects, subject_id = users.setdefault(object_id, {}), user_id
+            else:
+                subjects, subject_id = groups.setdefault(object_id, {}), group_id
+            subjects[subject_id] = subjects.get(subject_id, 0) | bit
+        return users, groups
+
+    def refresh(self, force=False):
+        """ Brings the snapshot up to date (if it was last checked more
+        than BOP_SNAPSHOT_INTERVAL seconds ago)
+        """
+        now = time.time()
+        if not force and now - self.checked < _interval():
+            return
+        with self.lock:
+            self.checked = now
+            if changelog_enabled():
+                state, changed = self._changes_from_log()
+            else:
+                state, changed = self._changes_from_counter()
+            if state == self.state and not changed:
+                return
+            if changed is None:
+                perms = []
+                users, groups = self._load(perms)
+                self.index = (perms, users, groups)
+            elif changed:
+                perms, users, groups = self.index
+                new_users, new_groups = self._load(perms, list(changed))
+                for object_id in changed:
+                    self._replace(users, object_id, new_users.get(object_id))
+                    self._replace(groups, object_id, new_groups.get(object_id))
+            self.state = state
+
+    def _changes_from_counter(self):
+        """ Returns the state of the counter and the ids of the objects
+        that changed since self.state (None if they are not known)
+        """
+        key = _counter_key(self.content_type.pk)
+        epoch, counter = _get_counter(self.content_type.pk)
+        if self.state is None or epoch != self.state[0] or \
+                counter <= self.state[1]:
+            return (epoch, counter), None
+        entries = cache.get_many(['%s:%d' % (key, n) for n in
+                                  range(self.state[1] + 1, counter + 1)])
+        if len(entries) != counter - self.state[1]:
+            return (epoch, counter), None
+        changed = set()
+        for object_ids in entries.values():
+            changed.update(object_ids)
+        return (epoch, counter), changed
+
+    def _changes_from_log(self):
+        """ Returns the state of the change log and the ids of the
+        objects that changed since self.state (None if they are not
+        known)
+
+        Changes of the last BOP_CHANGE_LOG_WINDOW seconds are read
+        again: a transaction that committed late can add a change with
+        a lower version than the snapshot already has.
+        """
+        oldest, latest = version_range()
+        if self.state is None or self.state[0] != 'log' or \
+                oldest > self.state[1] + 1:
+            # Pruned past our version; reload everything
+            self.seen = set()
+            return ('log', latest), None
+        changed, seen = set(), set()
+        for version, object_id in recent_changes(
+                self.state[1], self.content_type).filter(
+                pk__lte=latest).values_list('pk', 'object_id'):
+            seen.add(version)
+            if version not in self.seen:
+                changed.add(object_id)
+        self.seen = seen
+        return ('log', latest), changed
+
+    def _replace(self, index, object_id, subjects):
+        if subjects:
+            index[object_id] = subjects
+        else:
+            index.pop(object_id, None)
+
+    def get_permissions(self, user_id, group_ids, object_id):
+        """ Returns the permissions of the user (with `group_ids`) on the
+        object
+        """
+        perms, users, groups = self.index
+        bits = users.get(object_id, {}).get(user_id, 0)
+        groups = groups.get(object_id)
+        if groups:
+            for group_id in group_ids:
+                bits |= groups.get(group_id, 0)
+        return set([perm for i, perm in enumerate(perms) if bits & 1 << i])
+
+
+# content_type.pk -> Snapshot
+_snapshots = {}
+
+
+def get_snapshot(content_type):
+    """ Returns the (refreshed) Snapshot of `content_type` or None if
+    snapshots are not enabled for it
+    """
+    if not snapshot_enabled(content_type):
+        return None
+    snapshot = _snapshots.get(content_type.pk)
+    if snapshot is None:
+        snapshot = _snapshots.setdefault(content_type.pk, Snapshot(content_type))
+    snapshot.refresh()
+    return snapshot
+
+
+def _record_changes(sender, added, removed, **kwargs):
+    object_ids = {}
+    for key in added + removed:
+        object_ids.setdefault(key.content_type_id, set()).add(key.object_id)
+    for ct_id, ids in object_ids.items():
+        if not snapshot_enabled(ContentType.objects.get_for_id(ct_id)):
+            continue
+        snapshot = _snapshots.get(ct_id)
+        if changelog_enabled():
+            if snapshot is not None:
+                snapshot.checked = 0
+            continue
+        key = _counter_key(ct_id)
+        _get_counter(ct_id)
+        try:
+            counter = cache.incr(key)
+        except ValueError:
+            # Lost the counter; the next refresh reloads everything
+            continue
+        cache.set('%s:%d' % (key, counter), sorted(ids), _timeout())
+        # Changes in this process are seen right away
+        if snapshot is not None:
+            snapshot.checked = 0
+
+
+permissions_changed.connect(_record_changes,
+                            dispatch_uid='bop.snapshot._record_changes')
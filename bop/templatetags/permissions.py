@@ -1,44 +1,36 @@
 from django import template
-from django.core.urlresolvers import reverse
 from django.core.exceptions import ImproperlyConfigured
-from django.contrib.auth.models import User, AnonymousUser
-from django.core.urlresolvers import reverse
 
 
 register = template.Library()
 
 
-# Taken from http://bitbucket.org/jezdez/django-authority/src/tip/authority/templatetags/permissions.py
-# Made it less flexible ;-)
+def get_object_permissions(context, user, obj):
+    """ Returns the set of permissions `user` has on `obj`
 
-class ResolverNode(template.Node):
-    """
-    A small wrapper that adds a convenient resolve method.
+    The set is remembered in the context so several checks on the same
+    object in one template cost a single lookup.
     """
-    def resolve(self, var, context):
-        """Resolves a variable out of context if it's not in quotes"""
-        if var is None:
-            return var
-        if var[0] in ('"', "'") and var[-1] == var[0]:
-            return var[1:-1]
-        else:
-            return template.Variable(var).resolve(context)
+    cache = context.get('_bop_object_perms')
+    if cache is None:
+        # Stored in the outermost dict so it survives {% for %} etc.
+        cache = context.dicts[0]['_bop_object_perms'] = {}
+    key = (getattr(user, 'pk', None), obj.__class__, getattr(obj, 'pk', id(obj)))
+    if key not in cache:
+        cache[key] = user.get_all_permissions(obj)
+    return cache[key]
 
-    @classmethod
-    def next_bit_for(cls, bits, key, if_none=None):
-        try:
-            return bits[bits.index(key)+1]
-        except ValueError:
-            return if_none
 
+# Taken from http://bitbucket.org/jezdez/django-authority/src/tip/authority/templatetags/permissions.py
+# Made it less flexible ;-)
 
-class PermissionComparisonNode(ResolverNode):
+class PermissionComparisonNode(template.Node):
     """
     Implements a node to provide an "if user/group has permission on object"
     """
     @classmethod
     def handle_token(cls, parser, token):
-        bits = token.contents.split()
+        bits = token.split_contents()
         if len(bits) != 4:
             raise template.TemplateSyntaxError(
                 "'%s' tag takes four arguments" % bits[0])
@@ -50,7 +42,10 @@ class PermissionComparisonNode(ResolverNode):
             parser.delete_first_token()
         else:
             nodelist_false = template.NodeList()
-        return cls(bits[2], bits[1], nodelist_true, nodelist_false, bits[3])
+        return cls(parser.compile_filter(bits[2]),
+                   parser.compile_filter(bits[1]),
+                   nodelist_true, nodelist_false,
+                   parser.compile_filter(bits[3]))
 
     def __init__(self, user, perm, nodelist_true, nodelist_false, obj):
         self.user = user
@@ -61,10 +56,11 @@ class PermissionComparisonNode(ResolverNode):
 
     def render(self, context):
         try:
-            user = self.resolve(self.user, context)
-            perm = self.resolve(self.perm, context)
-            obj = self.resolve(self.obj, context)
-            if user.has_perm(perm, obj):
+            user = self.user.resolve(context)
+            perm = self.perm.resolve(context)
+            obj = self.obj.resolve(context)
+            if (user.is_active and user.is_superuser) or \
+                    perm in get_object_permissions(context, user, obj):
                 # return True if check was successful
                 return self.nodelist_true.render(context)
         # If the app couldn't be found
@@ -78,6 +74,22 @@ class PermissionComparisonNode(ResolverNode):
             return ''
         return self.nodelist_false.render(context)
 
+
+class ObjectPermissionsNode(template.Node):
+    def __init__(self, user, obj, varname):
+        self.user = user
+        self.obj = obj
+        self.varname = varname
+
+    def render(self, context):
+        try:
+            user = self.user.resolve(context)
+            obj = self.obj.resolve(context)
+            context[self.varname] = get_object_permissions(context, user, obj)
+        except (template.VariableDoesNotExist, TypeError, AttributeError):
+            context[self.varname] = set()
+        return ''
+
 @register.tag
 def ifhasperm(parser, token):
     """
@@ -100,3 +112,27 @@ def ifhasperm(parser, token):
     """
     return PermissionComparisonNode.handle_token(parser, token)
 
+
+@register.tag
+def get_object_perms(parser, token):
+    """
+    Puts the set of permissions USER has on OBJ in the context
+
+    Syntax::
+
+        {% get_object_perms USER OBJ as VARNAME %}
+
+        {% get_object_perms request.user poll as perms %}
+        {% if "polls.change_poll" in perms %}
+            ...
+        {% endif %}
+
+    The permissions are looked up once per user and object; later
+    ifhasperm tags on the same object reuse them.
+    """
+    bits = token.split_contents()
+    if len(bits) != 5 or bits[3] != 'as':
+        raise template.TemplateSyntaxError(
+            "'%s' tag requires the form: USER OBJ as VARNAME" % bits[0])
+    return ObjectPermissionsNode(parser.compile_filter(bits[1]),
+                                 parser.compile_filter(bits[2]), bits[4])
@@ -5,13 +5,19 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ImproperlyConfigured
 from django.db.models.query import QuerySet
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+try:
+    from django.utils.unittest import skipIf
+except ImportError: # Django >= 1.9
+    from unittest import skipIf
 
 from bop.models import ObjectPermission
 from bop.api import grant, revoke
+from bop.tokens import signing
 
 from bop.tests.tablemanager import TableManager
-from bop.tests.models import Thing
+from bop.tests.models import Thing, ManagedThing, TypedThing, \
+    TypedThingPermission
 
 
 class BOPTestCase(TestCase):
@@ -182,18 +188,16 @@ class TestObjectBackendNoAnonymous(BOPTestCase):
         else:
             self.assertFalse(self.anonymous.has_perm('bop.delete_thing'))
             self.assertFalse(self.anonymous.has_perm('bop.delete_thing', t))
-        # Note: ObjectBackend.has_module_perms will never be called
-        # (when AUTHENTICATION_BACKENDS is configured as intended with
-        # ModelBackend (first) and ObjectBackend working in
-        # conjunction. In the following case it is *ModelBackend* that
-        # gets called. 
-        #
-        # The takeaway is: A user can have ObjectLevelPermissions for
-        # a certain object but still have has_module_perms return
-        # False... Such a thing should preferably be avoided...
-        self.assertFalse(self.anonuser.has_module_perms('bop'))
-        self.assertFalse(self.anonymous.has_module_perms('bop'))
-        self.assertFalse(self.testuser.has_module_perms('bop'))
+        # ObjectBackend.has_module_perms is True for users with
+        # ObjectPermissions on objects in the app (so it shows up in
+        # the admin index)
+        self.assertTrue(self.anonuser.has_module_perms('bop'))
+        if hasattr(settings, 'ANONYMOUS_USER_ID'):
+            self.assertTrue(self.anonymous.has_module_perms('bop'))
+        else:
+            self.assertFalse(self.anonymous.has_module_perms('bop'))
+        self.assertTrue(self.testuser.has_module_perms('bop'))
+        self.assertFalse(self.testuser.has_module_perms('auth'))
         self.assertTrue(self.superuser.has_module_perms('bop'))
 
     def test_manager(self):
@@ -382,3 +386,1134 @@ class TestNoObjectBackend(BOPTestCase):
         
     def test(self):
         self.assertRaises(ImproperlyConfigured, _ = ObjectPermission.objects.all())
+
+
+class TestOrphans(BOPTestCase):
+
+    def test(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.db.models.signals import post_delete
+        from bop.models import remove_object_permissions
+        thinga = Thing(label='thinga')
+        thinga.save()
+        thingb = Thing(label='thingb')
+        thingb.save()
+        grant(self.testuser, self.someperms, 'bop.change_thing', [thinga, thingb])
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 4)
+        # Without the handler the ObjectPermissions are left behind
+        thinga.delete()
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 4)
+        call_command('bop_gc', dry_run=True, stdout=StringIO())
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 4)
+        call_command('bop_gc', chunk_size=1, stdout=StringIO())
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 2)
+        # With the handler they are removed right away
+        post_delete.connect(remove_object_permissions, sender=Thing)
+        try:
+            thingb.delete()
+        finally:
+            post_delete.disconnect(remove_object_permissions, sender=Thing)
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 0)
+
+
+class TestExportImport(BOPTestCase):
+
+    def test(self):
+        import os
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command
+        grant(self.testuser, self.someperms, ['bop.change_thing', 'bop.do_thing'], self.thing)
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 4)
+        for format in ('jsonl', 'csv'):
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                call_command('bop_export', 'bop.thing', format=format,
+                             output=path, chunk_size=3, stderr=StringIO())
+                # Importing what is already there is a no-op
+                call_command('bop_import', path, format=format, stderr=StringIO())
+                self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 4)
+                ObjectPermission.objects.get_for_model(Thing).delete()
+                call_command('bop_import', path, format=format,
+                             batch_size=3, stderr=StringIO())
+                self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 4)
+                self.assertTrue(self.testuser.has_perm('bop.do_thing', self.thing))
+            finally:
+                os.remove(path)
+
+    def test_shared_codename(self):
+        from bop.management.commands.bop_import import Resolver
+        ct = ContentType.objects.get_for_model(Thing)
+        other = Permission.objects.create(
+            codename='do_thing', name='Can do a typed thing',
+            content_type=ContentType.objects.get_for_model(TypedThing))
+        try:
+            op = Resolver()({'permission': 'bop.do_thing',
+                             'content_type': 'bop.thing',
+                             'object_id': self.thing.pk,
+                             'user': self.testuser.username})
+            self.assertEqual(op.permission, Permission.objects.get(
+                    content_type=ct, codename='do_thing'))
+        finally:
+            other.delete()
+
+    def test_malformed_rows(self):
+        import os
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command
+        row = '{"permission": "bop.do_thing", "content_type": "bop.thing", ' \
+            '"user": "bop_test", "object_id": %s}\n'
+        fd, path = tempfile.mkstemp()
+        os.write(fd, row % '"slug"' + '{"user": "bop_test"}\n[]\n' +
+                 row % self.thing.pk)
+        os.close(fd)
+        try:
+            err = StringIO()
+            call_command('bop_import', path, stderr=err)
+        finally:
+            os.remove(path)
+        self.assertTrue('inserted 1, skipped 3' in err.getvalue())
+        self.assertTrue(self.testuser.has_perm('bop.do_thing', self.thing))
+
+
+class TestForms(BOPTestCase):
+
+    def test(self):
+        from bop.forms import inline_permissions_form_factory, _permissions_cache
+        ct = ContentType.objects.get_for_model(Thing)
+        perm = Permission.objects.get(codename='change_thing', content_type=ct)
+        FormSet = inline_permissions_form_factory(Thing, extra=2)
+        prefix = FormSet(instance=self.thing).prefix
+        data = {prefix + '-TOTAL_FORMS': '2',
+                prefix + '-INITIAL_FORMS': '0',
+                prefix + '-MAX_NUM_FORMS': '',
+                prefix + '-0-user': str(self.testuser.pk),
+                prefix + '-0-permission': str(perm.pk),
+                prefix + '-1-group': str(self.someperms.pk),
+                prefix + '-1-permission': str(perm.pk)}
+        formset = FormSet(data, instance=self.thing)
+        self.assertTrue(formset.is_valid())
+        self.assertEqual(len(formset.save()), 2)
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 2)
+        self.assertTrue(ct.pk in _permissions_cache)
+        # Delete the user's permission
+        op = ObjectPermission.objects.get(user=self.testuser)
+        data = {prefix + '-TOTAL_FORMS': '1',
+                prefix + '-INITIAL_FORMS': '1',
+                prefix + '-MAX_NUM_FORMS': '',
+                prefix + '-0-id': str(op.pk),
+                prefix + '-0-user': str(self.testuser.pk),
+                prefix + '-0-permission': str(perm.pk),
+                prefix + '-0-DELETE': 'on'}
+        formset = FormSet(data, instance=self.thing,
+                          queryset=ObjectPermission.objects.filter(pk=op.pk))
+        self.assertTrue(formset.is_valid())
+        formset.save()
+        self.assertEqual(formset.deleted_objects, [op])
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 1)
+        # Invalid permissions are rejected
+        data = {prefix + '-TOTAL_FORMS': '1',
+                prefix + '-INITIAL_FORMS': '0',
+                prefix + '-MAX_NUM_FORMS': '',
+                prefix + '-0-user': str(self.testuser.pk),
+                prefix + '-0-permission': '-1'}
+        self.assertFalse(FormSet(data, instance=self.thing).is_valid())
+        # Changing a permission clears the cache
+        perm.save()
+        self.assertFalse(ct.pk in _permissions_cache)
+
+
+class TestMembershipCache(BOPTestCase):
+    def setUp(self):
+        super(TestMembershipCache, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        settings.BOP_MEMBERSHIP_CACHE = True
+
+    def tearDown(self):
+        del settings.BOP_MEMBERSHIP_CACHE
+        super(TestMembershipCache, self).tearDown()
+
+    def test(self):
+        thinga = Thing(label='thinga')
+        thinga.save()
+        grant(self.testuser, None, 'bop.change_thing', thinga)
+        self.assertTrue(self.testuser.has_perm('bop.change_thing', thinga))
+        self.assertFalse(self.testuser.has_perm('bop.change_thing', self.thing))
+        # Objects without any ObjectPermissions don't hit the database
+        self.assertNumQueries(0, self.testuser.has_perm,
+                              'bop.change_thing', self.thing)
+        # Granting invalidates the cache
+        grant(None, self.someperms, 'bop.change_thing', self.thing)
+        self.assertTrue(self.testuser.has_perm('bop.change_thing', self.thing))
+        # And so does creating ObjectPermissions directly
+        thingb = Thing(label='thingb')
+        thingb.save()
+        self.assertFalse(self.testuser.has_perm('bop.change_thing', thingb))
+        ObjectPermission.objects.create(
+            user=self.testuser, object_id=thingb.pk,
+            content_type=ContentType.objects.get_for_model(Thing),
+            permission=Permission.objects.get(codename='change_thing'))
+        self.assertTrue(self.testuser.has_perm('bop.change_thing', thingb))
+        revoke(self.testuser, None, 'bop.change_thing', thingb)
+        self.assertFalse(self.testuser.has_perm('bop.change_thing', thingb))
+
+
+class TestPreloadPermissions(BOPTestCase):
+    def setUp(self):
+        super(TestPreloadPermissions, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        settings.BOP_PRELOAD_PERMISSIONS = True
+
+    def tearDown(self):
+        del settings.BOP_PRELOAD_PERMISSIONS
+        super(TestPreloadPermissions, self).tearDown()
+
+    def test(self):
+        from bop.caches import get_user_index
+        thinga = Thing(label='thinga')
+        thinga.save()
+        grant(self.testuser, None, ['bop.change_thing', 'bop.do_thing'], thinga)
+        grant(None, self.someperms, 'bop.delete_thing', self.thing)
+        self.assertEqual(self.testuser.get_all_permissions(thinga),
+                         set(['bop.change_thing', 'bop.do_thing']))
+        self.assertEqual(self.testuser.get_all_permissions(self.thing),
+                         set(['bop.delete_thing']))
+        ct = ContentType.objects.get_for_model(Thing)
+        self.assertEqual(len(get_user_index(self.testuser)[ct.pk][1]), 2)
+        # Revoking (for a group) refreshes the index
+        revoke(None, self.someperms, 'bop.delete_thing', self.thing)
+        self.assertFalse(self.testuser.has_perm('bop.delete_thing', self.thing))
+        # and so does changing the user's groups
+        grant(None, self.anons, 'bop.mark_thing', self.thing)
+        self.assertFalse(self.testuser.has_perm('bop.mark_thing', self.thing))
+        self.testuser.groups.add(self.anons)
+        self.assertTrue(self.testuser.has_perm('bop.mark_thing', self.thing))
+        self.testuser.groups.remove(self.anons)
+        self.assertFalse(self.testuser.has_perm('bop.mark_thing', self.thing))
+
+
+class TestRouter(BOPTestCase):
+    def setUp(self):
+        super(TestRouter, self).setUp()
+        settings.BOP_READ_DATABASE = 'replica'
+
+    def tearDown(self):
+        from bop.routers import unpin_primary
+        del settings.BOP_READ_DATABASE
+        unpin_primary()
+        super(TestRouter, self).tearDown()
+
+    def test(self):
+        from django.test.client import RequestFactory
+        from django.http import HttpResponse
+        from bop.middleware import PinPrimaryMiddleware
+        from bop.api import filter_permitted
+        from bop.routers import ObjectPermissionRouter, unpin_primary
+        router = ObjectPermissionRouter()
+        self.assertEqual(router.db_for_read(ObjectPermission), 'replica')
+        self.assertEqual(router.db_for_read(Thing), None)
+        self.assertEqual(router.db_for_write(ObjectPermission), None)
+        # Granting pins reads to the primary
+        grant(self.testuser, None, 'bop.change_thing', self.thing)
+        self.assertEqual(router.db_for_read(ObjectPermission), None)
+        # and the middleware makes that stick in the next request
+        middleware = PinPrimaryMiddleware()
+        request = RequestFactory().get('/')
+        unpin_primary()
+        middleware.process_request(request)
+        grant(self.testuser, None, 'bop.delete_thing', self.thing)
+        response = middleware.process_response(request, HttpResponse())
+        self.assertTrue('bop_pin' in response.cookies)
+        unpin_primary()
+        self.assertEqual(router.db_for_read(ObjectPermission), 'replica')
+        request = RequestFactory().get('/')
+        request.COOKIES['bop_pin'] = response.cookies['bop_pin'].value
+        middleware.process_request(request)
+        self.assertEqual(router.db_for_read(ObjectPermission), None)
+        # Nothing changed in this request so no new cookie is set
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse('bop_pin' in response.cookies)
+
+    def test_two_databases(self):
+        import os
+        import tempfile
+        from django.core.management.color import no_style
+        from django.db import connections, router
+        from bop.routers import ObjectPermissionRouter, unpin_primary
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+        routers = router.routers
+        router.routers = [ObjectPermissionRouter()]
+        try:
+            # An empty replica that has not caught up with the primary
+            replica = connections['replica']
+            cursor = replica.cursor()
+            for model in (ContentType, Permission, ObjectPermission):
+                for statement in replica.creation.sql_create_model(
+                        model, no_style())[0]:
+                    cursor.execute(statement)
+            ops = lambda: ObjectPermission.objects.filter(
+                object_id=self.thing.pk,
+                content_type=ContentType.objects.get_for_model(Thing))
+            grant(self.testuser, None, 'bop.change_thing', self.thing)
+            # Reads right after the write go to the primary
+            self.assertEqual(ops().db, 'default')
+            self.assertEqual(ops().count(), 1)
+            self.assertTrue(self.testuser.has_perm('bop.change_thing', self.thing))
+            unpin_primary()
+            self.assertEqual(ops().db, 'replica')
+            self.assertEqual(ops().count(), 0)
+            # The group filter of the checks runs on the replica too
+            self.assertFalse(self.testuser.has_perm('bop.change_thing', self.thing))
+            self.assertEqual(filter_permitted(
+                    self.testuser, 'bop.change_thing', [self.thing]), [])
+            self.assertEqual(ObjectPermission.objects.get_for_user(
+                    self.testuser).count(), 0)
+        finally:
+            router.routers = routers
+            connections['replica'].close()
+            del connections.databases['replica']
+            try:
+                del connections._connections['replica']
+            except TypeError: # Django >= 1.6 keeps them per thread
+                delattr(connections._connections, 'replica')
+            except KeyError:
+                pass
+            os.remove(path)
+
+
+class TestTemplateTags(BOPTestCase):
+    def setUp(self):
+        super(TestTemplateTags, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+
+    def render(self, source, **kwargs):
+        from django.template import Template, Context
+        return Template('{% load permissions %}' + source).render(Context(kwargs))
+
+    def test(self):
+        grant(self.testuser, None, ['bop.change_thing', 'bop.delete_thing'], self.thing)
+        source = ('{% ifhasperm "bop.change_thing" user thing %}c{% endifhasperm %}'
+                  '{% ifhasperm "bop.delete_thing" user thing %}d{% endifhasperm %}'
+                  '{% ifhasperm "bop.do_thing" user thing %}x{% else %}-{% endifhasperm %}')
+        self.assertEqual(self.render(source, user=self.testuser, thing=self.thing), 'cd-')
+        # All three checks share one lookup
+        self.assertNumQueries(1, self.render, source, user=self.testuser, thing=self.thing)
+        self.assertEqual(self.render(source, user=self.superuser, thing=self.thing), 'cdx')
+        self.assertEqual(self.render(source, user=self.anonymous, thing=self.thing), '--')
+        source = ('{% get_object_perms user thing as perms %}'
+                  '{% if "bop.change_thing" in perms %}c{% endif %}'
+                  '{% ifhasperm "bop.change_thing" user thing %}C{% endifhasperm %}')
+        self.assertEqual(self.render(source, user=self.testuser, thing=self.thing), 'cC')
+        self.assertNumQueries(1, self.render, source, user=self.testuser, thing=self.thing)
+        self.assertEqual(self.render(source, user=self.anonymous, thing=self.thing), '')
+
+
+class TestFilterPermitted(BOPTestCase):
+    def setUp(self):
+        super(TestFilterPermitted, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['django.contrib.auth.backends.ModelBackend', 'bop.backends.ObjectBackend']
+
+    def test(self):
+        from bop.api import filter_permitted
+        things = [self.thing]
+        for label in ('thinga', 'thingb', 'thingc'):
+            things.append(Thing(label=label))
+            things[-1].save()
+        mixed = [things[3], self.someperms, things[0], things[2], things[1]]
+        grant(self.testuser, None, 'bop.change_thing', things[1])
+        grant(None, self.someperms, 'bop.change_thing', things[3])
+        grant(self.testuser, None, 'bop.delete_thing', things[2])
+        self.assertEqual(filter_permitted(self.testuser, 'bop.change_thing', mixed),
+                         [things[3], things[1]])
+        self.assertNumQueries(1, filter_permitted, self.testuser, 'bop.change_thing', mixed)
+        self.assertEqual(filter_permitted(self.anonymous, 'bop.change_thing', mixed), [])
+        self.assertEqual(filter_permitted(self.superuser, 'bop.change_thing', mixed), mixed)
+        self.assertEqual(filter_permitted(self.testuser, 'auth.change_group', mixed), [])
+        ct = ContentType.objects.get_for_model(Thing)
+        self.testuser.user_permissions.add(
+            Permission.objects.get(codename='change_thing', content_type=ct))
+        testuser = User.objects.get(pk=self.testuser.pk)
+        self.assertEqual(filter_permitted(testuser, 'bop.change_thing', mixed, True), mixed)
+        testuser.user_permissions.clear()
+
+
+class TestWithUserPerms(BOPTestCase):
+
+    def test(self):
+        from bop.managers import UserObjectManager
+        UserObjectManager().contribute_to_class(Thing, 'objects')
+        thinga = Thing(label='thinga')
+        thinga.save()
+        grant(self.testuser, None, ['bop.change_thing', 'bop.do_thing'], thinga)
+        grant(None, self.someperms, 'bop.delete_thing', [thinga, self.thing])
+        self.assertNumQueries(
+            2, lambda: list(Thing.objects.with_user_perms(self.testuser)))
+        things = list(Thing.objects.with_user_perms(self.testuser).order_by('label'))
+        self.assertEqual([t.label for t in things], ['a thing', 'thinga'])
+        self.assertEqual(things[0].user_perms, set(['delete_thing']))
+        self.assertEqual(things[1].user_perms,
+                         set(['change_thing', 'do_thing', 'delete_thing']))
+        things = Thing.objects.with_user_perms(self.testuser, 'bop.do_thing')
+        self.assertEqual([t.user_perms for t in things],
+                         [set(['change_thing', 'do_thing', 'delete_thing'])])
+        things = Thing.objects.with_user_perms(self.superuser)
+        self.assertTrue('mark_thing' in things[0].user_perms)
+        self.assertEqual(list(Thing.objects.with_user_perms(self.anonymous)), [])
+
+
+class TestUserObjectsPage(BOPTestCase):
+
+    def test(self):
+        from bop.managers import UserObjectManager
+        UserObjectManager().contribute_to_class(Thing, 'objects')
+        things = []
+        for i in range(7):
+            things.append(Thing(label='thing%s' % i))
+            things[-1].save()
+        grant(self.testuser, None, ['bop.change_thing', 'bop.do_thing'], things[:3])
+        grant(None, self.someperms, 'bop.change_thing', things[2:5])
+        seen, cursor = [], None
+        while True:
+            page, cursor = Thing.objects.get_user_objects_page(
+                self.testuser, cursor, limit=2)
+            seen.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, things[:5])
+        page, cursor = Thing.objects.get_user_objects_page(
+            self.testuser, limit=10, permissions='bop.do_thing')
+        self.assertEqual((page, cursor), (things[:3], None))
+        page, cursor = Thing.objects.get_user_objects_page(self.superuser, limit=7)
+        self.assertEqual(page, list(Thing.objects.order_by('pk')[:7]))
+        page, cursor = Thing.objects.get_user_objects_page(self.superuser, cursor)
+        self.assertEqual(page, [things[-1]])
+        self.assertRaises(ValueError, Thing.objects.get_user_objects_page,
+                          self.testuser, 'not a cursor')
+
+
+class TestCountUserObjects(BOPTestCase):
+
+    def test(self):
+        from bop.api import count_user_objects
+        thinga = Thing(label='thinga')
+        thinga.save()
+        self.assertEqual(count_user_objects(self.testuser, Thing), 0)
+        grant(self.testuser, None, ['bop.change_thing', 'bop.do_thing'], thinga)
+        self.assertEqual(count_user_objects(self.testuser, Thing), 1)
+        # Cached
+        self.assertNumQueries(0, count_user_objects, self.testuser, Thing)
+        grant(None, self.someperms, 'bop.do_thing', self.thing)
+        self.assertEqual(count_user_objects(self.testuser, Thing), 2)
+        self.assertEqual(count_user_objects(self.testuser, Thing, 'bop.change_thing'), 1)
+        self.assertEqual(count_user_objects(self.testuser, Thing, 'bop.mark_thing'), 0)
+        self.testuser.groups.remove(self.someperms)
+        self.assertEqual(count_user_objects(self.testuser, Thing), 1)
+        self.testuser.groups.add(self.someperms)
+        self.assertEqual(count_user_objects(self.testuser, Thing), 2)
+        revoke(self.testuser, None, ['bop.change_thing', 'bop.do_thing'], thinga)
+        self.assertEqual(count_user_objects(self.testuser, Thing), 1)
+        self.assertEqual(count_user_objects(self.anonymous, Thing), 0)
+        self.assertEqual(count_user_objects(self.superuser, Thing), 2)
+
+
+class TestUsersWithPerm(BOPTestCase):
+
+    def test(self):
+        from bop.managers import chunked_iterator
+        thinga = Thing(label='thinga')
+        thinga.save()
+        testa = User.objects.create_user('test-a', 'test@example.com.invalid', 'test-a')
+        testa.groups.add(self.someperms)
+        grant(self.anonuser, None, 'bop.change_thing', self.thing)
+        grant(None, self.someperms, 'bop.change_thing', thinga)
+        grant(self.testuser, None, 'bop.change_thing', thinga)
+        grant(self.superuser, None, 'bop.do_thing', thinga)
+        users = ObjectPermission.objects.get_users_with_perm(thinga, 'bop.change_thing')
+        self.assertEqual(set(users), set([self.testuser, testa]))
+        self.assertNumQueries(1, list, users)
+        users = ObjectPermission.objects.get_users_with_perm_bulk(
+            [thinga, self.thing], 'bop.change_thing')
+        self.assertEqual(set(users), set([self.testuser, testa, self.anonuser]))
+        self.assertEqual(list(chunked_iterator(users, 2)),
+                         sorted([self.testuser, testa, self.anonuser], key=lambda u: u.pk))
+        self.assertEqual(list(ObjectPermission.objects.get_users_with_perm_bulk(
+                    [], 'bop.change_thing')), [])
+        testa.delete()
+
+
+class TestSetPermissions(BOPTestCase):
+
+    def test(self):
+        from bop.api import set_permissions
+        thinga = Thing(label='thinga')
+        thinga.save()
+        grant(self.testuser, self.someperms, ['bop.change_thing', 'bop.do_thing'], [self.thing, thinga])
+        self.assertEqual(ObjectPermission.objects.count(), 8)
+        added, removed = set_permissions(
+            [self.thing, thinga],
+            {self.testuser: ['bop.change_thing', 'bop.mark_thing'],
+             self.anons: 'bop.do_thing'})
+        # testuser: -do +mark, someperms: -change -do, anons: +do (for 2 things)
+        self.assertEqual((len(added), len(removed)), (4, 6))
+        self.assertEqual(ObjectPermission.objects.count(), 6)
+        self.assertEqual(self.testuser.get_all_permissions(thinga),
+                         set(['bop.change_thing', 'bop.mark_thing']))
+        # Applying the same grants again changes nothing
+        self.assertEqual(set_permissions([self.thing, thinga],
+                                         {self.testuser: ['bop.change_thing', 'bop.mark_thing'],
+                                          self.anons: 'bop.do_thing'}), ([], []))
+        added, removed = set_permissions(thinga, {})
+        self.assertEqual((len(added), len(removed)), (0, 3))
+        self.assertEqual(ObjectPermission.objects.count(), 3)
+        self.assertRaises(TypeError, set_permissions, thinga, {'bop_test': 'bop.do_thing'})
+
+
+class TestBatch(BOPTestCase):
+
+    def test(self):
+        from bop.api import batch
+        from bop.signals import permissions_changed
+        thinga = Thing(label='thinga')
+        thinga.save()
+        grant(self.testuser, None, 'bop.delete_thing', thinga)
+        sent = []
+        def receiver(sender, added, removed, **kwargs):
+            sent.append((len(added), len(removed)))
+        permissions_changed.connect(receiver)
+        try:
+            with batch() as b:
+                for thing in (self.thing, thinga):
+                    grant('bop_test', 'bop_someperms', ['bop.change_thing', 'bop.do_thing'], thing)
+                    revoke('bop_test', None, 'bop.do_thing', thing)
+                    revoke('bop_test', None, 'bop.delete_thing', thing)
+                with batch():
+                    grant(None, 'bop_anons', 'bop.mark_thing', thinga)
+                # Nothing happened yet
+                self.assertEqual(ObjectPermission.objects.count(), 1)
+        finally:
+            permissions_changed.disconnect(receiver)
+        # testuser: change x 2; someperms: change, do x 2; anons: mark
+        self.assertEqual(ObjectPermission.objects.count(), 7)
+        self.assertEqual((len(b.added), len(b.removed)), (7, 1))
+        self.assertEqual(sent, [(7, 1)])
+        self.assertFalse(self.testuser.has_perm('bop.delete_thing', thinga))
+        # An exception discards the batch
+        def fail():
+            with batch():
+                revoke(self.testuser, self.someperms, 'bop.change_thing', thinga)
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(ObjectPermission.objects.count(), 7)
+
+
+class TestSlowCheckLogging(BOPTestCase):
+    def setUp(self):
+        import logging
+        super(TestSlowCheckLogging, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = self.records.append
+        logging.getLogger('bop.slow').addHandler(self.handler)
+
+    def tearDown(self):
+        import logging
+        logging.getLogger('bop.slow').removeHandler(self.handler)
+        for name in ('BOP_SLOW_CHECK_MS', 'BOP_SLOW_CHECK_SAMPLE_RATE'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+        super(TestSlowCheckLogging, self).tearDown()
+
+    def test(self):
+        self.testuser.has_perm('bop.change_thing', self.thing)
+        self.assertEqual(self.records, [])
+        settings.BOP_SLOW_CHECK_MS = 0
+        settings.BOP_SLOW_CHECK_SAMPLE_RATE = 0.0
+        self.testuser.has_perm('bop.change_thing', self.thing)
+        self.assertEqual(self.records, [])
+        settings.BOP_SLOW_CHECK_SAMPLE_RATE = 1.0
+        self.testuser.has_perm('bop.change_thing', self.thing)
+        self.assertEqual(len(self.records), 1)
+        message = self.records[0].getMessage()
+        self.assertTrue('ObjectBackend' in message)
+        self.assertTrue('bop_objectpermission' in message)
+
+    def test_failed_explain(self):
+        from django.db import connection
+        from bop.diagnostics import EXPLAIN, explain
+        prefix = EXPLAIN.get(connection.vendor)
+        EXPLAIN[connection.vendor] = 'NOT EXPLAIN '
+        try:
+            plan = explain(ObjectPermission.objects.all())[2]
+        finally:
+            if prefix is None:
+                del EXPLAIN[connection.vendor]
+            else:
+                EXPLAIN[connection.vendor] = prefix
+        self.assertTrue(plan.startswith('EXPLAIN failed'))
+        # The connection can still be used
+        self.assertFalse(self.testuser.has_perm('bop.change_thing', self.thing))
+
+
+class TestLoadTest(BOPTestCase):
+
+    def test_insert_race(self):
+        # A row with the same key inserted by someone else between the
+        # check for existing rows and the insert is skipped
+        ct = ContentType.objects.get_for_model(Thing)
+        perm = Permission.objects.get(codename='change_thing', content_type=ct)
+        grant(self.testuser, None, 'bop.change_thing', self.thing)
+        racing = ObjectPermission(content_type=ct, object_id=self.thing.pk,
+                                  permission=perm, user=self.testuser)
+        new = ObjectPermission(content_type=ct, object_id=self.thing.pk,
+                               permission=perm, group=self.someperms)
+        self.assertEqual(ObjectPermission.objects._insert_batch([racing, new]),
+                         [new])
+        self.assertEqual(ObjectPermission.objects._insert_batch([racing]), [])
+        self.assertEqual(ObjectPermission.objects.get_for_model(Thing).count(), 2)
+        self.assertEqual(ObjectPermission.objects.filter(
+                user=self.testuser).count(), 1)
+        self.assertTrue(self.testuser.has_perm('bop.change_thing', self.thing))
+        self.assertFalse(self.anonuser.has_perm('bop.change_thing', self.thing))
+
+    def test_command(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        out = StringIO()
+        call_command('bop_loadtest', 'bop.thing', operations=50, seed=1,
+                     ratios='check=50,grant=25,revoke=25', stdout=out)
+        report = out.getvalue()
+        self.assertTrue('check' in report)
+        total = [line.split() for line in report.splitlines()
+                 if line.startswith('total')][0]
+        self.assertEqual(total[1:3], ['50', '0'])
+        self.assertRaises(CommandError, call_command, 'bop_loadtest',
+                          'bop.thing', ratios='objects=1', stdout=out)
+        self.assertRaises(CommandError, call_command, 'bop_loadtest',
+                          'bop.thing', ratios='fly=1', stdout=out)
+
+    def test_default_ratios(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from bop.management.commands.bop_loadtest import Worker
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        self.tablemanager.create_table(ManagedThing)
+        try:
+            things = [ManagedThing.objects.create(label='thing %d' % i)
+                      for i in range(3)]
+            stats, errors = Worker(
+                ManagedThing, 'bop.change_managedthing', [self.testuser.pk],
+                [thing.pk for thing in things], {'objects': 1}, seed=1).run(5)
+            self.assertEqual((len(stats['objects'][0]), stats['objects'][1]),
+                             (5, 0))
+            self.assertEqual(errors, {})
+            out = StringIO()
+            call_command('bop_loadtest', 'bop.managedthing', operations=100,
+                         seed=1, stdout=out)
+            total = [line.split() for line in out.getvalue().splitlines()
+                     if line.startswith('total')][0]
+            self.assertEqual(total[1:3], ['100', '0'])
+        finally:
+            ObjectPermission.objects.filter(
+                content_type=ContentType.objects.get_for_model(
+                    ManagedThing)).delete()
+            self.tablemanager.drop_table(ManagedThing)
+
+
+class TestTypedObjectPermission(BOPTestCase):
+    def setUp(self):
+        super(TestTypedObjectPermission, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        self.tablemanager.create_table(TypedThing, TypedThingPermission)
+        self.typed = TypedThing(label='a typed thing')
+        self.typed.save()
+
+    def tearDown(self):
+        self.tablemanager.drop_table(TypedThingPermission, TypedThing)
+        super(TestTypedObjectPermission, self).tearDown()
+
+    def test(self):
+        from bop.api import set_permissions, batch
+        from bop.models import get_permission_model
+        self.assertTrue(get_permission_model(TypedThing) is TypedThingPermission)
+        self.assertTrue(get_permission_model(self.thing) is ObjectPermission)
+        grant(self.anonuser, self.someperms, 'bop.change_typedthing', self.typed)
+        grant(self.anonuser, None, 'bop.change_thing', self.thing)
+        self.assertEqual(TypedThingPermission.objects.count(), 2)
+        self.assertEqual(ObjectPermission.objects.count(), 1)
+        self.assertTrue(self.testuser.has_perm('bop.change_typedthing', self.typed))
+        self.assertTrue(self.anonuser.has_perm('bop.change_typedthing', self.typed))
+        self.assertFalse(self.anonuser.has_perm('bop.delete_typedthing', self.typed))
+        self.assertEqual(list(TypedThing.objects.get_user_objects(self.testuser)),
+                         [self.typed])
+        self.assertEqual(
+            [obj.user_perms for obj in TypedThing.objects.with_user_perms(self.anonuser)],
+            [set(['change_typedthing'])])
+        self.assertEqual(set(ObjectPermission.objects.get_users_with_perm_bulk(
+                    [self.typed, self.thing], 'bop.change_typedthing')),
+                         set([self.testuser, self.anonuser]))
+        revoke(None, self.someperms, 'bop.change_typedthing', self.typed)
+        self.assertFalse(self.testuser.has_perm('bop.change_typedthing', self.typed))
+        with batch():
+            grant(self.testuser, None, 'bop.delete_typedthing', self.typed)
+            revoke(self.anonuser, None, 'bop.change_thing', self.thing)
+        self.assertTrue(self.testuser.has_perm('bop.delete_typedthing', self.typed))
+        self.assertEqual(ObjectPermission.objects.count(), 0)
+        added, removed = set_permissions(self.typed, {self.testuser: 'bop.change_typedthing'})
+        self.assertEqual((len(added), len(removed)), (1, 2))
+        # Deleting the object deletes its permissions
+        self.typed.delete()
+        self.assertEqual(TypedThingPermission.objects.count(), 0)
+
+
+class TestSnapshot(BOPTestCase):
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        settings.BOP_SNAPSHOT_CONTENT_TYPES = ['bop.thing']
+
+    def tearDown(self):
+        del settings.BOP_SNAPSHOT_CONTENT_TYPES
+        super(TestSnapshot, self).tearDown()
+
+    def test(self):
+        from django.core.cache import cache
+        from bop.snapshot import get_snapshot, _counter_key
+        thinga = Thing(label='thinga')
+        thinga.save()
+        grant(self.testuser, None, ['bop.change_thing', 'bop.do_thing'], thinga)
+        grant(None, self.someperms, 'bop.delete_thing', self.thing)
+        self.assertEqual(self.testuser.get_all_permissions(thinga),
+                         set(['bop.change_thing', 'bop.do_thing']))
+        self.assertEqual(self.testuser.get_all_permissions(self.thing),
+                         set(['bop.delete_thing']))
+        self.assertFalse(self.anonuser.has_perm('bop.delete_thing', self.thing))
+        # Checks do not hit the database
+        self.assertNumQueries(0, self.testuser.has_perm, 'bop.change_thing', thinga)
+        # Changes are picked up incrementally: only the changed object
+        # is reloaded
+        revoke(None, self.someperms, 'bop.delete_thing', self.thing)
+        self.assertNumQueries(1, self.testuser.has_perm, 'bop.delete_thing', self.thing)
+        self.assertFalse(self.testuser.has_perm('bop.delete_thing', self.thing))
+        self.assertTrue(self.testuser.has_perm('bop.do_thing', thinga))
+        # Losing the changes in the cache reloads everything
+        grant(self.anonuser, None, 'bop.mark_thing', self.thing)
+        cache.delete(_counter_key(ContentType.objects.get_for_model(Thing).pk))
+        self.assertTrue(self.anonuser.has_perm('bop.mark_thing', self.thing))
+        snapshot = get_snapshot(ContentType.objects.get_for_model(Thing))
+        self.assertEqual(len(snapshot.index[1]), 2)
+        self.assertEqual(snapshot.index[2], {})
+
+
+class TestAdminActions(BOPTestCase):
+
+    def test(self):
+        from django.contrib import admin
+        from django.test.client import RequestFactory
+        from bop.admin import ObjectAdmin
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        model_admin = ObjectAdmin(Thing, admin.site)
+        messages = []
+        model_admin.message_user = lambda request, message: messages.append(message)
+        for label in ('thinga', 'thingb'):
+            Thing(label=label).save()
+        ct = ContentType.objects.get_for_model(Thing)
+        perms = Permission.objects.filter(
+            content_type=ct, codename__in=['change_thing', 'do_thing'])
+        data = {'apply': '1', 'users': [self.testuser.pk], 'groups': [self.anons.pk],
+                'permissions': [p.pk for p in perms]}
+        request = RequestFactory().post('/', data)
+        request.user = self.superuser
+        self.assertEqual(model_admin.grant_permissions(
+                request, Thing.objects.all()), None)
+        self.assertEqual(ObjectPermission.objects.count(), 12)
+        self.assertTrue(self.anonuser.has_perm('bop.do_thing', self.thing))
+        data['permissions'] = [perms.get(codename='do_thing').pk]
+        request = RequestFactory().post('/', data)
+        request.user = self.superuser
+        model_admin.revoke_permissions(request, Thing.objects.exclude(pk=self.thing.pk))
+        self.assertEqual(ObjectPermission.objects.count(), 8)
+        self.assertEqual(len(messages), 2)
+        # Choosing neither users nor groups is an error
+        from bop.forms import BulkPermissionForm
+        self.assertFalse(BulkPermissionForm(Thing, {'permissions': data['permissions']}).is_valid())
+
+
+class TestWithObjects(BOPTestCase):
+
+    def test(self):
+        from django.contrib import admin
+        from bop.admin import ObjectPermissionAdmin
+        thinga = Thing(label='thinga')
+        thinga.save()
+        grant(self.testuser, self.someperms, ['bop.change_thing', 'bop.do_thing'],
+              [self.thing, thinga])
+        ContentType.objects.get_for_model(Thing)
+        def render():
+            return [unicode(op) for op in ObjectPermission.objects.with_objects()]
+        # One query for the ObjectPermissions and one for the Things
+        self.assertNumQueries(2, render)
+        self.assertEqual(len(render()), 8)
+        model_admin = ObjectPermissionAdmin(ObjectPermission, admin.site)
+        op = ObjectPermission.objects.with_objects().filter(
+            group=self.someperms, object_id=thinga.pk)[0]
+        self.assertEqual(model_admin.subject(op), self.someperms)
+        self.assertEqual(model_admin.object_label(op), thinga)
+        thinga.delete()
+        self.assertEqual(len([op for op in ObjectPermission.objects.with_objects()
+                              if op.object is None]), 4)
+
+    def test_registered_once(self):
+        from django.contrib import admin
+        import bop.admin
+        # Importing bop.admin again does not raise AlreadyRegistered
+        reload(bop.admin)
+        self.assertTrue(ObjectPermission in admin.site._registry)
+
+
+class TestUniqueness(BOPTestCase):
+
+    def test(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.db import IntegrityError, transaction
+        grant(self.testuser, self.someperms, 'bop.change_thing', self.thing)
+        # Both user and group grants are unique, although one of the
+        # columns is NULL
+        for op in list(ObjectPermission.objects.all()):
+            duplicate = ObjectPermission(
+                user=op.user, group=op.group, permission=op.permission,
+                content_type=op.content_type, object_id=op.object_id)
+            sid = transaction.savepoint()
+            self.assertRaises(IntegrityError, duplicate.save)
+            transaction.savepoint_rollback(sid)
+        out = StringIO()
+        call_command('bop_dedupe', dry_run=True, stdout=out)
+        call_command('bop_dedupe', chunk_size=1, stdout=out)
+        self.assertTrue(out.getvalue().endswith('Total: 0\n'))
+        self.assertEqual(ObjectPermission.objects.count(), 2)
+
+    def test_merge(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        # A table from before the constraints, with real duplicates
+        opts = TypedThingPermission._meta
+        unique_together, opts.unique_together = opts.unique_together, ()
+        try:
+            self.tablemanager.create_table(TypedThing, TypedThingPermission)
+        finally:
+            opts.unique_together = unique_together
+        try:
+            typed = TypedThing.objects.create(label='a typed thing')
+            perm = Permission.objects.get(codename='change_typedthing')
+            kept = [TypedThingPermission.objects.create(
+                    object=typed, permission=perm, user=self.testuser),
+                    TypedThingPermission.objects.create(
+                    object=typed, permission=perm, group=self.someperms)]
+            for i in range(2):
+                for op in kept:
+                    TypedThingPermission.objects.create(
+                        object=typed, permission=perm, user=op.user,
+                        group=op.group)
+            out = StringIO()
+            call_command('bop_dedupe', dry_run=True, stdout=out)
+            self.assertTrue(out.getvalue().endswith('Total: 4\n'))
+            out = StringIO()
+            call_command('bop_dedupe', chunk_size=1, stdout=out)
+            self.assertTrue(out.getvalue().endswith('Total: 4\n'))
+            # The oldest row of each set survives
+            self.assertEqual(sorted(TypedThingPermission.objects.values_list(
+                        'pk', flat=True)), sorted([op.pk for op in kept]))
+            self.assertTrue(self.testuser.has_perm('bop.change_typedthing', typed))
+        finally:
+            self.tablemanager.drop_table(TypedThingPermission, TypedThing)
+
+
+class TestModelAndModulePerms(BOPTestCase):
+    def setUp(self):
+        super(TestModelAndModulePerms, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+
+    def test(self):
+        from bop.backends import ObjectBackend
+        backend = ObjectBackend()
+        self.assertFalse(backend.has_model_perms(self.testuser, Thing))
+        self.assertFalse(self.testuser.has_module_perms('bop'))
+        grant(None, self.someperms, 'bop.do_thing', self.thing)
+        self.assertTrue(backend.has_model_perms(self.testuser, Thing))
+        self.assertFalse(backend.has_model_perms(self.testuser, User))
+        self.assertFalse(backend.has_model_perms(self.anonuser, Thing))
+        self.assertTrue(self.testuser.has_module_perms('bop'))
+        # The answer is cached
+        self.assertNumQueries(0, self.testuser.has_module_perms, 'bop')
+        # until the user's permissions change
+        revoke(None, self.someperms, 'bop.do_thing', self.thing)
+        self.assertFalse(self.testuser.has_module_perms('bop'))
+        self.assertFalse(backend.has_model_perms(self.testuser, Thing))
+
+
+class TestNestedGroups(BOPTestCase):
+    def setUp(self):
+        super(TestNestedGroups, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        settings.BOP_NESTED_GROUPS = True
+        self.division = Group.objects.create(name='bop_division')
+        self.department = Group.objects.create(name='bop_department')
+
+    def tearDown(self):
+        del settings.BOP_NESTED_GROUPS
+        Group.objects.filter(
+            pk__in=[self.division.pk, self.department.pk]).delete()
+        super(TestNestedGroups, self).tearDown()
+
+    def test(self):
+        from bop.groups import nest_group, unnest_group
+        from bop.models import GroupClosure
+        nest_group(self.division, self.department)
+        nest_group(self.department, self.someperms)
+        self.assertEqual(GroupClosure.objects.get(
+                ancestor=self.division, descendant=self.someperms).depth, 2)
+        grant(None, self.division, 'bop.do_thing', self.thing)
+        self.assertTrue(self.testuser.has_perm('bop.do_thing', self.thing))
+        self.assertFalse(self.anonuser.has_perm('bop.do_thing', self.thing))
+        self.assertTrue(self.testuser in ObjectPermission.objects.get_users_with_perm(
+                self.thing, 'bop.do_thing'))
+        self.assertRaises(ValueError, nest_group, self.someperms, self.division)
+        self.assertRaises(ValueError, nest_group, self.division, self.division)
+        unnest_group(self.department, self.someperms)
+        self.assertFalse(GroupClosure.objects.filter(
+                descendant=self.someperms).exists())
+        self.assertFalse(self.testuser.has_perm('bop.do_thing', self.thing))
+
+    def test_delete_middle_group(self):
+        from bop.groups import nest_group
+        from bop.models import GroupClosure
+        nest_group(self.division, self.department)
+        nest_group(self.department, self.someperms)
+        grant(None, self.division, 'bop.do_thing', self.thing)
+        self.assertTrue(self.testuser.has_perm('bop.do_thing', self.thing))
+        self.department.delete()
+        self.assertFalse(GroupClosure.objects.filter(
+                descendant=self.someperms).exists())
+        self.assertFalse(self.testuser.has_perm('bop.do_thing', self.thing))
+
+    def test_concurrent_cycle(self):
+        from bop.groups import nest_group
+        from bop.models import GroupNesting
+        nest_group(self.division, self.department)
+        # Committed by another transaction after this one's cycle check
+        # read GroupClosure
+        GroupNesting.objects.create(parent=self.someperms, child=self.division)
+        self.assertRaises(ValueError, nest_group, self.department, self.someperms)
+
+    def test_delete_disabled(self):
+        from bop.groups import _group_deleting
+        settings.BOP_NESTED_GROUPS = False
+        # Deleting a group does not look at GroupClosure
+        self.assertNumQueries(0, _group_deleting, Group, instance=self.division)
+        self.assertFalse(hasattr(self.division, '_bop_nested'))
+
+
+class TestTokens(BOPTestCase):
+    @skipIf(signing is None, "django.core.signing requires Django 1.4 or later")
+    def test(self):
+        from bop import tokens
+        thinga = Thing(label='thinga')
+        thinga.save()
+        grant(self.testuser, None, 'bop.change_thing', self.thing)
+        grant(None, self.someperms, 'bop.do_thing', self.thing)
+        token = tokens.make_token(self.testuser, objects=[self.thing, thinga])
+        # Checking needs no queries
+        self.assertNumQueries(0, tokens.has_perm, token, 'bop.do_thing', self.thing)
+        perms = tokens.load_token(token)
+        self.assertEqual(perms.get_all_permissions(self.thing),
+                         set(['bop.change_thing', 'bop.do_thing']))
+        self.assertTrue(perms.has_perm('bop.do_thing', ('bop.thing', self.thing.pk)))
+        self.assertFalse(perms.has_perm('bop.do_thing', thinga))
+        self.assertTrue(perms.covers(thinga))
+        self.assertFalse(perms.covers(('bop.thing', 0)))
+        # All objects of a model
+        perms = tokens.load_token(tokens.make_token(self.testuser, models=[Thing]))
+        self.assertTrue(perms.covers(('bop.thing', 0)))
+        self.assertTrue(tokens.has_perm(
+                tokens.make_token(self.testuser, models=[Thing]),
+                'bop.change_thing', self.thing))
+        self.assertFalse(tokens.load_token(tokens.make_token(
+                    self.anonuser, models=[Thing])).has_perm(
+                'bop.change_thing', self.thing))
+        self.assertRaises(tokens.signing.BadSignature,
+                          tokens.load_token, token, key='another key')
+        self.assertRaises(tokens.signing.SignatureExpired, tokens.load_token,
+                          tokens.make_token(self.testuser, [self.thing], max_age=-1))
+
+
+class TestChangeLog(BOPTestCase):
+    def setUp(self):
+        super(TestChangeLog, self).setUp()
+        settings.AUTHENTICATION_BACKENDS = ['bop.backends.ObjectBackend']
+        settings.BOP_CHANGE_LOG = True
+
+    def tearDown(self):
+        del settings.BOP_CHANGE_LOG
+        super(TestChangeLog, self).tearDown()
+
+    def test(self):
+        from bop.api import changes_since, current_version
+        ct = ContentType.objects.get_for_model(Thing)
+        version = current_version()
+        grant(self.testuser, self.someperms, 'bop.do_thing', self.thing)
+        revoke(self.testuser, None, 'bop.do_thing', self.thing)
+        changes = list(changes_since(version, ct))
+        changes = [(c.added, c.user_id, c.group_id) for c in changes]
+        self.assertEqual(sorted(changes[:2]), [(True, None, self.someperms.pk),
+                                               (True, self.testuser.pk, None)])
+        self.assertEqual(changes[2:], [(False, self.testuser.pk, None)])
+        changes = list(changes_since(version))
+        self.assertEqual(changes[-1].version, current_version())
+        self.assertEqual(changes[-1].key.object_id, self.thing.pk)
+        self.assertEqual(list(changes_since(current_version())), [])
+
+    def test_snapshot(self):
+        settings.BOP_SNAPSHOT_CONTENT_TYPES = ['bop.thing']
+        try:
+            grant(self.testuser, None, 'bop.do_thing', self.thing)
+            self.assertTrue(self.testuser.has_perm('bop.do_thing', self.thing))
+            # The versions in the log, the changes since the snapshot's
+            # version and the changed object
+            revoke(self.testuser, None, 'bop.do_thing', self.thing)
+            self.assertNumQueries(3, self.testuser.has_perm,
+                                  'bop.do_thing', self.thing)
+            self.assertFalse(self.testuser.has_perm('bop.do_thing', self.thing))
+        finally:
+            del settings.BOP_SNAPSHOT_CONTENT_TYPES
+
+    def test_snapshot_late_commit(self):
+        from bop.managers import permission_key
+        from bop.models import ObjectPermissionChange
+        from bop.signals import muted
+        from bop.snapshot import get_snapshot
+        settings.BOP_SNAPSHOT_CONTENT_TYPES = ['bop.thing']
+        try:
+            ct = ContentType.objects.get_for_model(Thing)
+            thinga = Thing.objects.create(label='thinga')
+            grant(self.anonuser, None, 'bop.mark_thing', self.thing)
+            self.assertFalse(self.testuser.has_perm('bop.do_thing', self.thing))
+            # A transaction writes a grant and takes a version ...
+            with muted():
+                op = ObjectPermission.objects.create(
+                    content_type=ct, object_id=self.thing.pk,
+                    user=self.testuser, permission=Permission.objects.get(
+                        content_type=ct, codename='do_thing'))
+            late = ObjectPermissionChange(added=True,
+                                          **permission_key(op)._asdict())
+            late.save()
+            version = late.pk
+            late.delete()
+            # ... but a later grant commits first
+            grant(self.anonuser, None, 'bop.mark_thing', thinga)
+            self.assertFalse(self.testuser.has_perm('bop.do_thing', self.thing))
+            # The late change is still picked up
+            ObjectPermissionChange(pk=version, added=True,
+                                   **permission_key(op)._asdict()).save(
+                force_insert=True)
+            get_snapshot(ct).refresh(force=True)
+            self.assertTrue(self.testuser.has_perm('bop.do_thing', self.thing))
+        finally:
+            del settings.BOP_SNAPSHOT_CONTENT_TYPES
+
+    def test_prune(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from bop.api import current_version
+        from bop.models import ObjectPermissionChange
+        grant(self.testuser, None, ['bop.do_thing', 'bop.mark_thing'], self.thing)
+        version = current_version()
+        out = StringIO()
+        call_command('bop_prune_changes', days=0, stdout=out)
+        # The latest change is kept
+        self.assertEqual(list(ObjectPermissionChange.objects.values_list(
+                    'pk', flat=True)), [version])
+        self.assertEqual(current_version(), version)
+
+
+class TestChangeLogRollback(TransactionTestCase):
+    fixtures = ['users.json', ]
+
+    def setUp(self):
+        settings.BOP_CHANGE_LOG = True
+        self.testuser = User.objects.get(username='bop_test')
+        self.tablemanager = TableManager()
+        self.tablemanager.create_table(Thing)
+        self.thing = Thing.objects.create(label='a thing')
+
+    def tearDown(self):
+        del settings.BOP_CHANGE_LOG
+        ObjectPermission.objects.all().delete()
+        self.tablemanager.drop_table(Thing)
+
+    def test(self):
+        from bop.api import changes_since, current_version, set_permissions
+        from bop.signals import permissions_changed, permissions_written
+        version = current_version()
+        changed = []
+        def fail(sender, **kwargs):
+            raise RuntimeError("failed")
+        def record(sender, **kwargs):
+            changed.append(kwargs)
+        # Connected after the change log, so the log has been written
+        permissions_written.connect(fail, dispatch_uid='bop.tests.fail')
+        permissions_changed.connect(record, dispatch_uid='bop.tests.record')
+        try:
+            self.assertRaises(RuntimeError, set_permissions, self.thing,
+                              {self.testuser: ['bop.change_thing']})
+        finally:
+            permissions_written.disconnect(dispatch_uid='bop.tests.fail')
+            permissions_changed.disconnect(dispatch_uid='bop.tests.record')
+        self.assertEqual(list(changes_since(version)), [])
+        self.assertEqual(changed, [])
+        self.assertEqual(ObjectPermission.objects.count(), 0)
+
+    def test_sent_after_commit(self):
+        from bop.managers import atomic
+        from bop.signals import permissions_changed, _send_uncommitted
+        # Left over by the tests that ran in a transaction
+        _send_uncommitted()
+        changed = []
+        def record(sender, added, removed, **kwargs):
+            changed.append(bool(added))
+        permissions_changed.connect(record, dispatch_uid='bop.tests.record')
+        try:
+            with atomic():
+                grant(self.testuser, None, 'bop.change_thing', self.thing)
+                self.assertEqual(changed, [True])
+            # Sent again after the commit, at the latest with the next
+            # change outside a transaction
+            revoke(self.testuser, None, 'bop.change_thing', self.thing)
+        finally:
+            permissions_changed.disconnect(dispatch_uid='bop.tests.record')
+        self.assertEqual(changed, [True, True, False])
+
+    def test_outer_rollback(self):
+        from bop.api import set_permissions
+        from bop.managers import atomic
+        grant(self.testuser, None, 'bop.change_thing', self.thing)
+        def replace():
+            with atomic():
+                set_permissions(self.thing,
+                                {self.testuser: ['bop.delete_thing']})
+                raise RuntimeError("failed")
+        self.assertRaises(RuntimeError, replace)
+        # Neither the deletes nor the inserts of set_permissions were
+        # committed on their own
+        self.assertEqual(list(ObjectPermission.objects.values_list(
+                    'permission__codename', flat=True)), ['change_thing'])
@@ -1,5 +1,8 @@
 from django.db import models
 
+from bop.managers import UserObjectManager
+from bop.models import TypedObjectPermission
+
 # Test 'model'
 class Thing(models.Model):
     label = models.CharField(max_length=255, unique=True) 
@@ -13,3 +16,36 @@ class Thing(models.Model):
 
     def __unicode__(self):
         return self.label
+
+
+# A 'model' with a UserObjectManager (and the generic ObjectPermissions)
+class ManagedThing(models.Model):
+    label = models.CharField(max_length=255, unique=True)
+
+    objects = UserObjectManager()
+
+    class Meta:
+        app_label = 'bop'
+
+    def __unicode__(self):
+        return self.label
+
+
+# A 'model' with a permission table of its own
+class TypedThing(models.Model):
+    label = models.CharField(max_length=255, unique=True)
+
+    objects = UserObjectManager()
+
+    class Meta:
+        app_label = 'bop'
+
+    def __unicode__(self):
+        return self.label
+
+
+class TypedThingPermission(TypedObjectPermission):
+    object = models.ForeignKey(TypedThing)
+
+    class Meta(TypedObjectPermission.Meta):
+        app_label = 'bop'
@@ -0,0 +1,164 @@
+""" Signed permission tokens
+
+make_token exports the ObjectPermissions of a user on some objects, or
+on all objects of some models, as a compact signed token. Services that
+can not reach the database check permissions with the token alone::
+
+  from bop.tokens import load_token
+
+  perms = load_token(token, key=SHARED_KEY)
+  perms.has_perm('myapp.change_document', ('myapp.document', 42))
+
+Tokens are signed with BOP_TOKEN_KEY (default: SECRET_KEY) and expire
+after BOP_TOKEN_MAX_AGE seconds (default 300). Loading a token only
+needs django.core.signing (Django >= 1.4), not the database.
+"""
+import time
+
+try:
+    from django.core import signing
+except ImportError: # Django < 1.4
+    signing = None
+
+
+SALT = 'bop.tokens'
+
+
+def _signing():
+    if signing is None:
+        from django.core.exceptions import ImproperlyConfigured
+        raise ImproperlyConfigured("bop.tokens requires django.core.signing "
+                                   "(Django 1.4 or later)")
+    return signing
+
+
+def _key(key):
+    if key is None:
+        from django.conf import settings
+        key = getattr(settings, 'BOP_TOKEN_KEY', None)
+    return key
+
+
+def _model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def _object_label(obj):
+    """ Returns ('app_label.model', object id) for a model instance or an
+    ('app_label.model', object id) tuple
+    """
+    if isinstance(obj, tuple):
+        return obj[0], unicode(obj[1])
+    return _model_label(obj), unicode(obj.pk)
+
+
+def make_token(user, objects=(), models=(), max_age=None, key=None):
+    """ Returns a signed token with the permissions of `user` (directly
+    and via groups) on `objects` and on all objects of `models`
+
+    The token expires after `max_age` seconds.
+    """
+    from django.conf import settings
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import Q
+    from bop.api import get_subject
+    from bop.caches import get_user_group_ids
+    from bop.models import get_permission_model
+
+    if max_age is None:
+        max_age = getattr(settings, 'BOP_TOKEN_MAX_AGE', 300)
+    subject = get_subject(user)
+    if subject is not None and not subject.is_active:
+        subject = None
+    perms = []
+    # 'app_label.model' -> [all objects?, {object id: bitset}]
+    types = {}
+    querysets = []
+    for model in models:
+        types[_model_label(model)] = [1, {}]
+        if subject is not None:
+            querysets.append((_model_label(model), get_permission_model(
+                        model).objects.get_for_model_and_user(model, subject)))
+    pks = {}
+    for obj in objects:
+        label = _model_label(obj)
+        if not types.get(label, [0])[0]:
+            types.setdefault(label, [0, {}])
+            pks.setdefault(obj.__class__, set()).add(obj.pk)
+    if subject is not None:
+        groups = get_user_group_ids(subject)
+        for model, ids in pks.items():
+            ops = get_permission_model(model).objects
+            ct = ContentType.objects.get_for_model(model)
+            ids = list(ids)
+            for i in range(0, len(ids), 500):
+                querysets.append((_model_label(model), ops.filter_objects(
+                            ct.pk, ids[i:i+500]).filter(
+                            Q(user=subject) | Q(group__in=groups))))
+    for label, ops in querysets:
+        objs = types[label][1]
+        for object_id, app_label, codename in ops.values_list(
+                ops.model.object_field, 'permission__content_type__app_label',
+                'permission__codename'):
+            perm = "%s.%s" % (app_label, codename)
+            if perm not in perms:
+                perms.append(perm)
+            object_id = unicode(object_id)
+            objs[object_id] = objs.get(object_id, 0) | 1 << perms.index(perm)
+    return _signing().dumps({
+            'u': user.pk,
+            's': int(user.is_active and user.is_superuser),
+            'x': int(time.time() + max_age),
+            'p': perms,
+            't': types,
+            }, key=_key(key), salt=SALT, compress=True)
+
+
+class TokenPermissions(object):
+    """ The permissions in a token (see load_token) """
+
+    def __init__(self, data):
+        self.user_id = data['u']
+        self.is_superuser = bool(data['s'])
+        self.expires = data['x']
+        self.perms = data['p']
+        self.types = data['t']
+
+    def covers(self, obj):
+        """ Are the permissions on `obj` in the token? """
+        label, object_id = _object_label(obj)
+        whole, objects = self.types.get(label, (0, {}))
+        return bool(whole) or object_id in objects
+
+    def get_all_permissions(self, obj):
+        """ Returns the permissions on `obj` (a model instance or an
+        ('app_label.model', object id) tuple)
+        """
+        label, object_id = _object_label(obj)
+        bits = self.types.get(label, (0, {}))[1].get(object_id, 0)
+        return set([perm for i, perm in enumerate(self.perms)
+                    if bits & 1 << i])
+
+    def has_perm(self, perm, obj):
+        """ Like User.has_perm(perm, obj). Objects the token does not
+        cover have no permissions.
+        """
+        return self.is_superuser or perm in self.get_all_permissions(obj)
+
+
+def load_token(token, key=None):
+    """ Returns the TokenPermissions in `token`
+
+    Raises django.core.signing.BadSignature if the token was tampered
+    with and SignatureExpired if it expired.
+    """
+    signing = _signing()
+    data = signing.loads(token, key=_key(key), salt=SALT)
+    if data['x'] < time.time():
+        raise signing.SignatureExpired("Token expired at %s" % data['x'])
+    return TokenPermissions(data)
+
+
+def has_perm(token, perm, obj, key=None):
+    """ Does the token grant `perm` on `obj`? """
+    return load_token(token, key).has_perm(perm, obj)